@@ -0,0 +1,167 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    BACKTEST - OUT-OF-SAMPLE ACCURACY OF THE SCORING MODELS
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+# Module 3 calibrates on one split: predictors as of 2015-01-01 and revenue
+# in 2015. A backtest repeats this for every calibration year Y: fit on the
+# predictors as of January 1st of Y and the revenue of Y, score the
+# predictors as of January 1st of Y + 1, and compare with the revenue of
+# Y + 1. All splits read one feature panel (rfm.compute_panel) and one
+# customers x years revenue matrix, both computed once, and run in parallel, e.g.
+#
+#   python backtest.py --input purchases.txt --jobs 8 --output backtest.csv
+#
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from purchases import load_purchases, purchase_years, purchase_amounts
+from rfm import RFM_MODEL_COLUMNS, compute_panel, panel_slice
+from scoring import score_chunk
+from instrument import traced
+
+
+# --- SHARED FEATURES --------------------------------------
+
+
+# Revenue of every customer in every year, in one pass over the purchases
+# Returns the customer ids (ascending) and a customers x years matrix
+def revenue_matrix(data, years):
+    ids, customer = np.unique(np.asarray(data['customer_id']), return_inverse=True)
+    year = purchase_years(data) - years[0]
+    keep = (year >= 0) & (year < len(years))
+    cells = customer[keep] * len(years) + year[keep]
+    revenue = np.bincount(cells, weights=purchase_amounts(data)[keep], minlength=len(ids) * len(years))
+    return ids, revenue.reshape(len(ids), len(years))
+
+
+# Predictors as of January 1st of 'year', with the revenue of that year
+def split_sample(panel, ids, revenue, years, year):
+    customers = panel_slice(panel, '%d-01-01' % year)
+    pos = np.searchsorted(ids, customers.customer_id.values)
+    customers['revenue'] = revenue[pos, years.index(year)]
+    return customers
+
+
+# Calibration years with a following year to test on
+def calibration_years(data):
+    years = np.unique(purchase_years(data))
+    return [int(y) for y in years[1:-1]]
+
+
+# --- METRICS ----------------------------------------------
+
+
+# Area under the ROC curve of a score for a binary outcome
+def auc(score, outcome):
+    from scipy.stats import rankdata
+    outcome = np.asarray(outcome, dtype=bool)
+    n_pos, n_neg = outcome.sum(), (~outcome).sum()
+    if n_pos == 0 or n_neg == 0:
+        return np.nan
+    return (rankdata(score)[outcome].sum() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+
+# Accuracy and calibration of the predictions of one test year
+def split_metrics(prob, revenue_predicted, score, revenue):
+    active = revenue > 0
+    clipped = np.clip(prob, 1e-15, 1 - 1e-15)
+    order = np.argsort(-score, kind='stable')
+    top = order[:max(len(order) // 10, 1)]
+    return {'customers': len(revenue),
+            'active_rate': active.mean(),
+            'mean_prob': prob.mean(),
+            'auc': auc(prob, active),
+            'log_loss': -np.mean(np.where(active, np.log(clipped), np.log(1 - clipped))),
+            'brier': np.mean((prob - active) ** 2),
+            'rmse_log_revenue': np.sqrt(np.mean((np.log(revenue_predicted[active]) - np.log(revenue[active])) ** 2)) if active.any() else np.nan,
+            'predicted_revenue': score.sum(),
+            'actual_revenue': revenue.sum(),
+            'revenue_ratio': score.sum() / revenue.sum() if revenue.sum() else np.nan,
+            'top_decile_share': revenue[top].sum() / revenue.sum() if revenue.sum() else np.nan}
+
+
+CALIBRATION_COLUMNS = ['customers', 'mean_prob', 'active_rate', 'mean_score', 'mean_revenue']
+
+
+# Predicted against actual activity and revenue by decile of score
+def calibration_table(score, prob, revenue, bins=10):
+    decile = pd.qcut(pd.Series(score).rank(method='first'), bins, labels=False)
+    frame = pd.DataFrame({'decile': bins - decile, 'prob': prob, 'active': revenue > 0, 'score': score, 'revenue': revenue})
+    return frame.groupby('decile').agg(customers=('score', 'size'), mean_prob=('prob', 'mean'), active_rate=('active', 'mean'),
+                                       mean_score=('score', 'mean'), mean_revenue=('revenue', 'mean'))
+
+
+# --- RUNNING THE SPLITS -----------------------------------
+
+
+# Fit on one calibration sample and score the test sample; a split whose
+# models cannot be fitted (no active or no inactive customer, perfect
+# separation, singular design) is reported with its error
+def backtest_split(year, in_sample, out_sample):
+    from statsmodels.tools.sm_exceptions import PerfectSeparationError
+    from pipeline import fit_in_sample
+    split = {'calibration_year': year, 'test_year': year + 1, 'error': None}
+    active = int((in_sample.revenue > 0).sum())
+    if active == 0 or active == len(in_sample):
+        return dict(split, error='%d of %d customers active in %d' % (active, len(in_sample), year)), None
+    try:
+        prob_model, amount_model = fit_in_sample(in_sample)
+    except (PerfectSeparationError, np.linalg.LinAlgError) as exc:
+        return dict(split, error='%s: %s' % (type(exc).__name__, exc)), None
+    prob, revenue_predicted, score = score_chunk({c: out_sample[c].values for c in RFM_MODEL_COLUMNS}, prob_model, amount_model)
+    revenue = out_sample.revenue.values
+    return dict(split, **split_metrics(prob, revenue_predicted, score, revenue)), calibration_table(score, prob, revenue)
+
+
+# Backtest every calibration year (default: all years with a following year)
+# Returns the metrics per split and the calibration tables, indexed by test year
+@traced('backtest')
+def backtest(data, years=None, n_jobs=1):
+    years = calibration_years(data) if years is None else sorted(years)
+    if not years:
+        raise ValueError('a backtest needs at least two years of purchases')
+    all_years = list(range(years[0], years[-1] + 2))
+    panel = compute_panel(data, ['%d-01-01' % y for y in all_years], RFM_MODEL_COLUMNS)
+    ids, revenue = revenue_matrix(data, all_years)
+    args = [(y, split_sample(panel, ids, revenue, all_years, y), split_sample(panel, ids, revenue, all_years, y + 1)) for y in years]
+    if n_jobs > 1 and len(args) > 1:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            results = list(pool.map(backtest_split, *zip(*args)))
+    else:
+        results = [backtest_split(*a) for a in args]
+    metrics = pd.DataFrame([m for m, _ in results]).set_index('calibration_year')
+    tables = {m['test_year']: t for m, t in results if t is not None}
+    if tables:
+        tables = pd.concat(tables, names=['test_year'])
+    else:
+        tables = pd.DataFrame(columns=CALIBRATION_COLUMNS, index=pd.MultiIndex.from_arrays([[], []], names=['test_year', 'decile']))
+    return metrics, tables
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Backtest the scoring models on every calibration year')
+    parser.add_argument('--input', default='purchases.txt')
+    parser.add_argument('--years', type=int, nargs='+', help='calibration years (default: all)')
+    parser.add_argument('--jobs', type=int, default=1, help='splits run in parallel')
+    parser.add_argument('--output', help='CSV file for the metrics per split')
+    parser.add_argument('--calibration', help='CSV file for the calibration tables')
+    args = parser.parse_args(argv)
+
+    metrics, tables = backtest(load_purchases(args.input, compact=True), args.years, args.jobs)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(metrics.round(4))
+    if args.output:
+        metrics.to_csv(args.output)
+    if args.calibration:
+        tables.to_csv(args.calibration)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    BENCHMARK - SCALING OF THE ANALYTICS PIPELINE
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+# Times every stage of the pipeline on synthetic purchase logs of growing
+# size and saves the results as JSON; the rfm_parallel stage (the rfm stage
+# through parallel.parallel_customers) runs once per number of processes in
+# --jobs, to measure how it scales, e.g.
+#
+#   python benchmark.py --rows 100000 1000000 10000000 --output new.json
+#   python benchmark.py --rows 100000 1000000 --baseline old.json
+#   python benchmark.py --rows 10000000 --stages rfm rfm_parallel --jobs 1 2 4 8 16 32
+#
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from synthetic import generate_rows, write_purchases
+from purchases import load_purchases, cache_dir
+from rfm import RFM_MODEL_COLUMNS, compute_customers, compute_revenue
+from parallel import parallel_customers
+from segmentation import segment_snapshots, SEGMENTS
+from clustering import ward_linkage, cut_customers
+from scoring import extract_model, score_customers
+from clv import transition_matrix, database_value, simulate_clv
+
+
+# --- STAGES -----------------------------------------------
+
+
+# Every stage reads what it needs from the context, stores what it produces,
+# and returns the number of rows it produced
+
+def stage_load_cold(ctx):
+    ctx['data'] = load_purchases(ctx['path'], compact=True)
+    return len(ctx['data'])
+
+
+def stage_load_warm(ctx):
+    ctx['data'] = load_purchases(ctx['path'], compact=True)
+    return len(ctx['data'])
+
+
+def stage_rfm(ctx):
+    data = ctx['data']
+    ctx['customers_2015'] = compute_customers(data, columns=RFM_MODEL_COLUMNS)
+    ctx['customers_2014'] = compute_customers(data, offset=365, columns=RFM_MODEL_COLUMNS)
+    ctx['revenue_2015'] = compute_revenue(data, 2015)
+    return len(ctx['customers_2015']) + len(ctx['customers_2014'])
+
+
+# Same aggregates as stage_rfm, over a pool of ctx['n_jobs'] processes
+def stage_rfm_parallel(ctx):
+    result = parallel_customers(ctx['data'], offsets=[0, 365], years=[2015], columns=RFM_MODEL_COLUMNS, n_jobs=ctx['n_jobs'])
+    return sum(len(customers) for customers in result['customers'])
+
+
+def stage_segmentation(ctx):
+    customers_2014, customers_2015 = ctx['customers_2014'], ctx['customers_2015']
+    customers_2014['segment'], customers_2015['segment'] = segment_snapshots([customers_2014, customers_2015])
+    return len(customers_2014) + len(customers_2015)
+
+
+def stage_clustering(ctx):
+    customers = ctx['customers_2015']
+    x = np.column_stack([customers.recency, customers.frequency, np.log(customers.avg_amount)])
+    x = (x - x.mean(axis=0)) / x.std(axis=0)
+    c, leaves = ward_linkage(x, n_centroids=ctx['n_centroids'])
+    ctx['members'] = cut_customers(c, leaves, n_clusters=9)
+    return len(ctx['members'])
+
+
+def stage_model_fit(ctx):
+    import statsmodels.api as sm
+    in_sample = pd.merge(ctx['customers_2014'], ctx['revenue_2015'], how='left')
+    in_sample['revenue_2015'] = in_sample.revenue_2015.fillna(0)
+    in_sample['active_2015'] = (in_sample.revenue_2015 > 0).astype(int)
+    ctx['prob_model'] = extract_model(sm.Logit.from_formula('active_2015 ~ recency + first_purchase + frequency + avg_amount + max_amount', in_sample).fit(disp=0))
+    active = in_sample[in_sample.active_2015 == 1]
+    ctx['amount_model'] = extract_model(sm.OLS.from_formula('np.log(revenue_2015) ~ np.log(avg_amount) + np.log(max_amount)', active).fit())
+    return len(in_sample)
+
+
+def stage_scoring(ctx):
+    customers = score_customers(ctx['customers_2015'], ctx['prob_model'], ctx['amount_model'])
+    return len(customers)
+
+
+def stage_transition(ctx):
+    counts = transition_matrix([ctx['customers_2014'], ctx['customers_2015']], normalize=False)
+    ctx['transition'] = counts.div(counts.sum(axis=1), axis=0).fillna(0)
+    return int(counts.values.sum())
+
+
+def stage_clv(ctx):
+    counts = ctx['customers_2015'].segment.value_counts(sort=False).reindex(SEGMENTS).fillna(0)
+    revenue = pd.Series([0, 0, 0, 0, 0, 323.57, 52.31, 79.17], index=SEGMENTS)
+    values = database_value(counts, ctx['transition'], revenue, np.arange(0.02, 0.21, 0.02), range(1, 51), infinite=True)
+    forward = pd.merge(ctx['customers_2015'][['customer_id', 'segment']], ctx['customers_2014'][['customer_id', 'segment']], on='customer_id', how='left')
+    forward = pd.merge(forward, ctx['revenue_2015'], how='left')
+    simulate_clv(forward.segment_y.cat.codes, forward.segment_x.cat.codes, forward.revenue_2015.fillna(0), counts, n_replicates=ctx['replicates'])
+    return values.size
+
+
+STAGES = [('load_cold', stage_load_cold), ('load_warm', stage_load_warm), ('rfm', stage_rfm), ('rfm_parallel', stage_rfm_parallel),
+          ('segmentation', stage_segmentation), ('clustering', stage_clustering), ('model_fit', stage_model_fit),
+          ('scoring', stage_scoring), ('transition', stage_transition), ('clv', stage_clv)]
+
+
+# Run before every pass of a stage, outside the measurement: the cold load
+# must parse the text file each time
+def clear_cache(ctx):
+    shutil.rmtree(cache_dir(ctx['path']), ignore_errors=True)
+
+
+SETUP = {'load_cold': clear_cache}
+
+
+# --- MEASURING --------------------------------------------
+
+
+# Wall time and CPU time of one call, then, with memory=True, peak traced
+# memory (numpy and python allocations) of a second call: tracemalloc slows
+# every allocation down, so it never runs while the stage is timed
+def measure(fn, ctx, memory=True, setup=None):
+    if setup:
+        setup(ctx)
+    wall, cpu = time.perf_counter(), time.process_time()
+    rows = fn(ctx)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    peak = None
+    if memory:
+        if setup:
+            setup(ctx)
+        tracemalloc.start()
+        try:
+            fn(ctx)
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return {'wall_s': wall, 'cpu_s': cpu, 'peak_mb': peak, 'memory': 'separate' if memory else 'off', 'output_rows': rows}
+
+
+# Stages run once per number of processes
+PARALLEL_STAGES = ['rfm_parallel']
+
+
+# Run all stages on a synthetic log of about n_rows purchases
+def run_benchmark(n_rows, stages=None, memory=True, seed=0, n_centroids=1000, replicates=200, workdir=None, jobs=(1,)):
+    stages = [s for s in STAGES if stages is None or s[0] in stages]
+    directory = tempfile.mkdtemp(prefix='purchases-', dir=workdir)
+    try:
+        path = os.path.join(directory, 'purchases.txt')
+        columns = generate_rows(n_rows, seed=seed)
+        write_purchases(columns, path)
+        ctx = {'path': path, 'n_centroids': n_centroids, 'replicates': replicates}
+        n_rows = len(columns['day'])
+        del columns
+        # Later stages need the data even if loading is not benchmarked
+        if not any(name.startswith('load') for name, _ in stages):
+            ctx['data'] = load_purchases(path, compact=True)
+        results = []
+        for name, fn in stages:
+            for n_jobs in jobs if name in PARALLEL_STAGES else [None]:
+                ctx['n_jobs'] = n_jobs
+                result = measure(fn, ctx, memory, SETUP.get(name))
+                result.update({'rows': n_rows, 'stage': name, 'n_jobs': n_jobs})
+                print('%12d rows  %-13s %4s %9.3f s  %9.3f s cpu  %s' % (n_rows, name, n_jobs or '', result['wall_s'], result['cpu_s'],
+                      '%9.1f MB' % result['peak_mb'] if result['peak_mb'] is not None else ''), file=sys.stderr)
+                results.append(result)
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pd.__version__}
+
+
+# --- REPORTS ----------------------------------------------
+
+
+# How memory was measured: 'separate' (peak traced in a second run of the
+# stage, times taken without tracing) or 'off'; results without a mode come
+# from reports that traced memory while timing ('inline')
+def memory_mode(result):
+    return result.get('memory', 'inline')
+
+
+# Ratios new / old of wall time and peak memory per (rows, stage, n_jobs),
+# only between results measured in the same memory mode
+def compare_reports(old, new):
+    old_results = {(r['rows'], r['stage'], r.get('n_jobs')): r for r in old['results']}
+    rows = []
+    for r in new['results']:
+        o = old_results.get((r['rows'], r['stage'], r.get('n_jobs')))
+        if o is None:
+            continue
+        if memory_mode(o) != memory_mode(r):
+            raise ValueError('%s at %d rows was measured with memory mode %r in the baseline and %r now, rerun both the same way'
+                             % (r['stage'], r['rows'], memory_mode(o), memory_mode(r)))
+        rows.append({'rows': r['rows'], 'stage': r['stage'], 'n_jobs': r.get('n_jobs'),
+                     'wall_ratio': r['wall_s'] / o['wall_s'] if o['wall_s'] else np.nan,
+                     'peak_ratio': r['peak_mb'] / o['peak_mb'] if r['peak_mb'] and o['peak_mb'] else np.nan})
+    return pd.DataFrame(rows, columns=['rows', 'stage', 'n_jobs', 'wall_ratio', 'peak_ratio'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the analytics pipeline on synthetic purchase logs')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000], help='purchase log sizes (1e5 to 1e8)')
+    parser.add_argument('--stages', nargs='+', choices=[name for name, _ in STAGES], help='stages to run (default: all)')
+    parser.add_argument('--output', default='benchmark.json', help='JSON report to write')
+    parser.add_argument('--baseline', help='JSON report of a previous version to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2, help='flag stages slower than threshold x baseline')
+    parser.add_argument('--no-memory', action='store_true', help='do not measure memory (skips the second, traced run of each stage)')
+    parser.add_argument('--centroids', type=int, default=1000, help='micro-clusters for the clustering stage')
+    parser.add_argument('--replicates', type=int, default=200, help='Monte Carlo replicates for the clv stage')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, os.cpu_count()], help='processes for the rfm_parallel stage')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='directory for the generated purchase logs')
+    args = parser.parse_args(argv)
+
+    results = []
+    for n_rows in args.rows:
+        results += run_benchmark(n_rows, args.stages, not args.no_memory, args.seed, args.centroids, args.replicates, args.workdir, sorted(set(args.jobs)))
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(),
+              'config': vars(args), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        try:
+            comparison = compare_reports(baseline, report)
+        except ValueError as e:
+            parser.error(str(e))
+        comparison['regression'] = comparison.wall_ratio > args.threshold
+        print(comparison.to_string(index=False))
+        return int(comparison.regression.any())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    CLUSTERING - HIERARCHICAL SEGMENTATION AT SCALE
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+import pandas as pd
+import numpy as np
+from scipy.spatial.distance import cdist
+from scipy.cluster.hierarchy import linkage, cut_tree
+from instrument import traced
+
+
+# --- PRE-CLUSTERING ---------------------------------------
+
+
+# Condense the customers into at most n_centroids micro-clusters with
+# mini-batch k-means: memory is bounded by the batch size and the run time
+# grows linearly with the number of customers (sklearn is imported on first use)
+# Returns the centroids, their sizes and the micro-cluster of every customer
+def precluster(x, n_centroids=1000, batch_size=10000, random_state=0):
+    from sklearn.cluster import MiniBatchKMeans
+    x = np.asarray(x, dtype=np.float64)
+    km = MiniBatchKMeans(n_clusters=n_centroids, batch_size=batch_size, n_init=1, random_state=random_state)
+    km.fit(x)
+    micro = np.concatenate([km.predict(x[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+    sizes = np.bincount(micro, minlength=n_centroids)
+    # Drop centroids that ended up with no customer
+    used = np.flatnonzero(sizes)
+    remap = np.full(n_centroids, -1)
+    remap[used] = np.arange(len(used))
+    return km.cluster_centers_[used], sizes[used], remap[micro]
+
+
+# --- WEIGHTED WARD LINKAGE --------------------------------
+
+
+# Ward linkage on weighted points (e.g. micro-cluster centroids weighted by
+# their number of customers), in the format of scipy.cluster.hierarchy.linkage
+# With unit weights this is the same as linkage(x, method='ward'); as scipy
+# requires, the last column counts the points (not their weights) below a node
+# Merges use the Lance-Williams update on squared distances, and a cache of
+# every row's nearest neighbour so each step only rescans the affected rows
+def weighted_ward(points, sizes):
+    points = np.asarray(points, dtype=np.float64)
+    n = np.asarray(sizes, dtype=np.float64).copy()
+    m = len(points)
+    d = cdist(points, points, 'sqeuclidean')
+    d *= 2 * np.outer(n, n) / np.add.outer(n, n)
+    np.fill_diagonal(d, np.inf)
+    nearest = d.argmin(axis=1)
+    nearest_d = d[np.arange(m), nearest]
+    cluster_id = np.arange(m)
+    count = np.ones(m)
+    z = np.zeros((m - 1, 4))
+    for step in range(m - 1):
+        i = int(nearest_d.argmin())
+        j = int(nearest[i])
+        h = d[i, j]
+        # Merge j into i, update distances from every cluster to the merged one
+        active = np.isfinite(nearest_d)
+        row = ((n + n[i]) * d[i] + (n + n[j]) * d[j] - n * h) / (n + n[i] + n[j])
+        row[~active] = np.inf
+        row[i] = row[j] = np.inf
+        d[i, :] = d[:, i] = row
+        d[j, :] = d[:, j] = np.inf
+        z[step] = [min(cluster_id[i], cluster_id[j]), max(cluster_id[i], cluster_id[j]), np.sqrt(max(h, 0)), count[i] + count[j]]
+        n[i] += n[j]
+        n[j] = 0
+        count[i] += count[j]
+        cluster_id[i] = m + step
+        nearest_d[j] = np.inf
+        # Refresh the nearest neighbour cache
+        stale = np.flatnonzero(((nearest == i) | (nearest == j)) & np.isfinite(nearest_d))
+        for k in stale:
+            nearest[k] = d[k].argmin()
+            nearest_d[k] = d[k, nearest[k]]
+        closer = np.flatnonzero(row < nearest_d)
+        nearest[closer] = i
+        nearest_d[closer] = row[closer]
+        if step < m - 2:
+            nearest[i] = row.argmin()
+            nearest_d[i] = row[nearest[i]]
+    return z
+
+
+# --- SEGMENTING THE FULL CUSTOMER BASE --------------------
+
+
+# Hierarchical (Ward) segmentation of the full customer base
+# Small bases are clustered exactly; larger ones are first condensed into
+# n_centroids micro-clusters, and Ward linkage runs on the weighted centroids
+# Returns the linkage matrix and the leaf of the tree every customer belongs to
+@traced('linkage')
+def ward_linkage(x, n_centroids=1000, batch_size=10000, random_state=0):
+    x = np.asarray(x, dtype=np.float64)
+    if len(x) <= n_centroids:
+        return linkage(x, method='ward'), np.arange(len(x))
+    centroids, sizes, micro = precluster(x, n_centroids, batch_size, random_state)
+    return weighted_ward(centroids, sizes), micro
+
+
+# Cut the tree into n_clusters segments and assign every customer to one
+@traced('cut_tree')
+def cut_customers(c, leaves, n_clusters, index=None):
+    segments = cut_tree(c, n_clusters=n_clusters).ravel()
+    return pd.DataFrame({'ClusterNumber': segments[leaves]}, index=index)
+
+
+# --- CHOOSING THE NUMBER OF SEGMENTS ----------------------
+
+
+# Cut the tree at every number of segments in ks at once
+# Customer-level sums are computed once per leaf of the tree, every cut then
+# only aggregates leaves, never customers again
+# x holds the clustering variables (for the within-segment sum of squares),
+# profile the variables to average per segment (x itself by default)
+# Returns the memberships (one column per k), the segment profiles indexed by
+# (k, ClusterNumber) with their size and means, and the within-segment sum of
+# squares for every k
+@traced('profile_cuts')
+def profile_cuts(c, leaves, x, ks=range(2, 16), profile=None):
+    ks = list(ks)
+    index = x.index if isinstance(x, pd.DataFrame) else None
+    if profile is None:
+        profile = x
+    x = np.asarray(x, dtype=np.float64)
+    profile = pd.DataFrame(profile)
+    n_leaves = len(c) + 1
+    leaves = np.asarray(leaves)
+    leaf_size = np.bincount(leaves, minlength=n_leaves).astype(np.float64)
+    leaf_sum = np.stack([np.bincount(leaves, weights=x[:, f], minlength=n_leaves) for f in range(x.shape[1])], axis=1)
+    leaf_sumsq = np.stack([np.bincount(leaves, weights=x[:, f] ** 2, minlength=n_leaves) for f in range(x.shape[1])], axis=1)
+    values = profile.values.astype(np.float64)
+    leaf_profile = np.stack([np.bincount(leaves, weights=values[:, f], minlength=n_leaves) for f in range(values.shape[1])], axis=1)
+
+    labels = cut_tree(c, n_clusters=ks)
+    dtype = np.int16 if max(ks) < np.iinfo(np.int16).max else np.int32
+    members = pd.DataFrame(labels[leaves].astype(dtype), index=index, columns=pd.Index(ks, name='k'))
+
+    profiles, wss = [], []
+    for i, k in enumerate(ks):
+        label = labels[:, i]
+        size = np.bincount(label, weights=leaf_size, minlength=k)
+        sums = np.stack([np.bincount(label, weights=leaf_sum[:, f], minlength=k) for f in range(x.shape[1])], axis=1)
+        sumsq = np.stack([np.bincount(label, weights=leaf_sumsq[:, f], minlength=k) for f in range(x.shape[1])], axis=1)
+        wss.append((sumsq - sums ** 2 / size[:, None]).sum())
+        means = np.stack([np.bincount(label, weights=leaf_profile[:, f], minlength=k) for f in range(values.shape[1])], axis=1) / size[:, None]
+        p = pd.DataFrame(means, columns=profile.columns)
+        p.insert(0, 'size', size.astype(np.int64))
+        p.index = pd.MultiIndex.from_product([[k], range(k)], names=['k', 'ClusterNumber'])
+        profiles.append(p)
+    return members, pd.concat(profiles), pd.Series(wss, index=pd.Index(ks, name='k'), name='wss')
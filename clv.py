@@ -0,0 +1,231 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    CLV - CUSTOMER LIFETIME VALUE OF A DATABASE
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+from segmentation import SEGMENTS
+from instrument import traced
+
+
+# --- TRANSITION MATRIX ------------------------------------
+
+
+# Segment codes of the customers 'ids' in another snapshot, -1 for customers
+# absent from it or with no segment there (a left join, without the merge)
+def align_codes(ids, other_ids, other_codes):
+    ids = np.asarray(ids)
+    other_ids = np.asarray(other_ids)
+    other_codes = np.asarray(other_codes, dtype=np.int64)
+    if len(other_ids) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    order = None
+    if (other_ids[1:] < other_ids[:-1]).any():
+        order = np.argsort(other_ids, kind='stable')
+        other_ids = other_ids[order]
+    pos = np.minimum(np.searchsorted(other_ids, ids), len(other_ids) - 1)
+    found = other_ids[pos] == ids
+    if order is not None:
+        pos = order[pos]
+    return np.where(found, other_codes[pos], -1)
+
+
+# Cell of the transition matrix of every customer, from * k + to,
+# and k * k for customers with no segment on either side
+def transition_cells(from_codes, to_codes, n_segments):
+    from_codes = np.asarray(from_codes, dtype=np.int64)
+    to_codes = np.asarray(to_codes, dtype=np.int64)
+    valid = (from_codes >= 0) & (to_codes >= 0)
+    return np.where(valid, from_codes * n_segments + to_codes, n_segments * n_segments)
+
+
+# Number of customers moving from each segment (rows) to each segment (columns)
+def transition_counts(from_codes, to_codes, n_segments, weights=None):
+    cells = transition_cells(from_codes, to_codes, n_segments)
+    counts = np.bincount(cells, weights=weights, minlength=n_segments * n_segments + 1)
+    return counts[:-1].reshape(n_segments, n_segments)
+
+
+# Segment codes of a snapshot given as a frame with customer_id and an
+# ordered categorical segment, or as a pair (customer ids, codes)
+def snapshot_codes(snapshot, segments):
+    if isinstance(snapshot, pd.DataFrame):
+        segment = snapshot['segment']
+        if list(segment.cat.categories) != list(segments):
+            segment = segment.cat.set_categories(segments)
+        return np.asarray(snapshot['customer_id']), np.asarray(segment.cat.codes, dtype=np.int64)
+    ids, codes = snapshot
+    return np.asarray(ids), np.asarray(codes, dtype=np.int64)
+
+
+# Estimate the transition matrix from consecutive snapshots (e.g. customers_2014,
+# customers_2015), pooling the moves of every consecutive pair in one count
+# Customers of a snapshot absent from the next one are left out, like the
+# left merge and crosstab of module 4
+# Rows and columns always come in the order of 'segments'; rows are divided
+# by their sum unless normalize=False (rows with no customer stay at 0)
+@traced('transition')
+def transition_matrix(snapshots, segments=SEGMENTS, normalize=True):
+    if len(snapshots) < 2:
+        raise ValueError('at least two snapshots are needed to estimate transitions')
+    k = len(segments)
+    snapshots = [snapshot_codes(s, segments) for s in snapshots]
+    cells = [transition_cells(codes, align_codes(ids, next_ids, next_codes), k)
+             for (ids, codes), (next_ids, next_codes) in zip(snapshots[:-1], snapshots[1:])]
+    counts = np.bincount(np.concatenate(cells), minlength=k * k + 1)[:-1].reshape(k, k)
+    index = pd.CategoricalIndex(segments, categories=segments, ordered=True)
+    if not normalize:
+        return pd.DataFrame(counts, index=index.rename('from'), columns=index.rename('to'))
+    totals = counts.sum(axis=1, keepdims=True)
+    return pd.DataFrame(counts / np.maximum(totals, 1), index=index.rename('from'), columns=index.rename('to'))
+
+
+# --- SEGMENT PROJECTION -----------------------------------
+
+
+# Align counts, transition matrix and revenue on the order of the counts,
+# segments missing from the transition matrix never move anywhere
+def align(counts, transition, revenue=None):
+    segments = counts.index if isinstance(counts, pd.Series) else None
+    if segments is not None and isinstance(transition, pd.DataFrame):
+        transition = transition.reindex(index=segments, columns=segments)
+    if segments is not None and isinstance(revenue, pd.Series):
+        revenue = revenue.reindex(segments)
+    counts = np.asarray(counts, dtype=np.float64)
+    transition = np.nan_to_num(np.asarray(transition, dtype=np.float64))
+    revenue = None if revenue is None else np.nan_to_num(np.asarray(revenue, dtype=np.float64))
+    return segments, counts, transition, revenue
+
+
+# Number of customers in each segment for every year from now to 'horizon'
+# years ahead: counts . transition^t, for t = 0 .. horizon
+def segment_trajectory(counts, transition, horizon):
+    trajectory = np.empty((horizon + 1, len(counts)))
+    trajectory[0] = counts
+    for t in range(1, horizon + 1):
+        trajectory[t] = trajectory[t - 1] @ transition
+    return trajectory
+
+
+# Same as the yearly loop of module 4: segments (rows) by year (columns)
+@traced('clv_projection')
+def project_segments(counts, transition, horizon=10, start=2015):
+    segments, counts, transition, _ = align(counts, transition)
+    trajectory = segment_trajectory(counts, transition, horizon)
+    return pd.DataFrame(trajectory.T, index=segments, columns=np.arange(start, start + horizon + 1))
+
+
+# --- DISCOUNTED VALUE OF THE DATABASE ---------------------
+
+
+# Discounted value of the database for every discount rate and horizon at once
+# The value at horizon H is the discounted revenue of years 1 .. H (today's
+# revenue is not counted, as in module 4); with infinite=True an extra 'inf'
+# column holds the limit, counts . ((I - P/(1+d))^-1 - I) . revenue, from a
+# linear solve per rate
+# Returns a frame indexed by discount rate with one column per horizon
+@traced('clv')
+def database_value(counts, transition, revenue, discount_rates=(0.10,), horizons=(10,), infinite=False):
+    segments, counts, transition, revenue = align(counts, transition, revenue)
+    rates = np.atleast_1d(np.asarray(discount_rates, dtype=np.float64))
+    horizons = np.atleast_1d(np.asarray(horizons, dtype=np.int64))
+    columns = [int(h) for h in horizons]
+    values = np.empty((len(rates), len(horizons) + bool(infinite)))
+    if len(horizons):
+        trajectory = segment_trajectory(counts, transition, int(horizons.max()))
+        yearly = trajectory @ revenue
+        discount = (1 + rates[:, None]) ** -np.arange(len(yearly))[None, :]
+        cumulated = np.cumsum(discount * yearly[None, :], axis=1) - yearly[0]
+        values[:, :len(horizons)] = cumulated[:, horizons]
+    if infinite:
+        k = len(counts)
+        system = np.eye(k)[None, :, :] - transition[None, :, :] / (1 + rates)[:, None, None]
+        per_segment = np.linalg.solve(system, np.broadcast_to(revenue, (len(rates), k))[:, :, None])[:, :, 0]
+        values[:, -1] = per_segment @ counts - counts @ revenue
+        columns.append('inf')
+    return pd.DataFrame(values, index=pd.Index(rates, name='discount_rate'), columns=columns)
+
+
+# --- MONTE CARLO CLV --------------------------------------
+
+
+# Transition matrices and revenue per segment re-estimated on bootstrap
+# samples of the customers
+# from_codes and to_codes are the segment codes of each customer last year
+# and this year (-1 for no segment, e.g. last year for new customers),
+# revenue what they spent this year
+# Transitions are counted from last year's segment; revenue is averaged by
+# this year's segment, the one it was earned in, like the revenue per
+# segment of database_value() and module 4
+# Returns arrays of shape (replicates, k, k) and (replicates, k)
+def bootstrap_estimates(from_codes, to_codes, revenue, n_segments, n_replicates, seed=0):
+    from_codes = np.asarray(from_codes, dtype=np.int64)
+    to_codes = np.asarray(to_codes, dtype=np.int64)
+    revenue = np.asarray(revenue, dtype=np.float64)
+    keep = (from_codes >= 0) | (to_codes >= 0)
+    from_codes, to_codes, revenue = from_codes[keep], to_codes[keep], revenue[keep]
+    cell = transition_cells(from_codes, to_codes, n_segments)
+    segment = np.where(to_codes >= 0, to_codes, n_segments)
+    rng = np.random.default_rng(seed)
+    n = len(from_codes)
+    transitions = np.zeros((n_replicates, n_segments, n_segments))
+    revenues = np.zeros((n_replicates, n_segments))
+    for b in range(n_replicates):
+        # How many times each customer is drawn in this replicate
+        weight = np.bincount(rng.integers(0, n, n), minlength=n).astype(np.float64)
+        counts = np.bincount(cell, weights=weight, minlength=n_segments * n_segments + 1)[:-1].reshape(n_segments, n_segments)
+        transitions[b] = counts / np.maximum(counts.sum(axis=1, keepdims=True), 1e-300)
+        size = np.bincount(segment, weights=weight, minlength=n_segments + 1)[:-1]
+        revenues[b] = np.bincount(segment, weights=weight * revenue, minlength=n_segments + 1)[:-1] / np.maximum(size, 1e-300)
+    return transitions, revenues
+
+
+# Yearly revenue of the database for many (transition, revenue) replicates at once
+# Returns an array of shape (replicates, horizon + 1)
+def project_replicates(counts, transitions, revenues, horizon):
+    n_replicates, k = revenues.shape
+    trajectory = np.broadcast_to(np.asarray(counts, dtype=np.float64), (n_replicates, k)).copy()
+    yearly = np.empty((n_replicates, horizon + 1))
+    yearly[:, 0] = np.einsum('bk,bk->b', trajectory, revenues)
+    for t in range(1, horizon + 1):
+        trajectory = np.einsum('bk,bkl->bl', trajectory, transitions)
+        yearly[:, t] = np.einsum('bk,bk->b', trajectory, revenues)
+    return yearly
+
+
+def simulate_batch(from_codes, to_codes, revenue, counts, n_replicates, horizon, seed):
+    transitions, revenues = bootstrap_estimates(from_codes, to_codes, revenue, len(counts), n_replicates, seed)
+    return project_replicates(counts, transitions, revenues, horizon)
+
+
+# Monte Carlo CLV: bootstrap today's customers, re-estimate the transition
+# matrix and revenue per segment for each replicate, and project today's
+# segment counts forward (see bootstrap_estimates())
+# Replicates are split in batches of batch_size, spread over n_jobs processes
+# Returns percentile intervals of the yearly and discounted cumulated revenue
+# (years by (measure, percentile)) and of the database value (years 1 .. horizon)
+@traced('clv_simulation')
+def simulate_clv(from_codes, to_codes, revenue, counts, n_replicates=1000, horizon=10, discount_rate=0.10,
+                 percentiles=(5, 50, 95), start=2015, n_jobs=1, batch_size=250, seed=0):
+    counts = np.asarray(counts, dtype=np.float64)
+    sizes = [min(batch_size, n_replicates - i) for i in range(0, n_replicates, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(from_codes, to_codes, revenue, counts, size, horizon, s) for size, s in zip(sizes, seeds)]
+    if n_jobs > 1 and len(args) > 1:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            yearly = list(pool.map(simulate_batch, *zip(*args)))
+    else:
+        yearly = [simulate_batch(*a) for a in args]
+    yearly = np.concatenate(yearly)
+    discount = (1 + discount_rate) ** -np.arange(horizon + 1)
+    disc_cumulated = np.cumsum(yearly * discount, axis=1)
+    worth = disc_cumulated[:, -1] - yearly[:, 0]
+    years = pd.Index(np.arange(start, start + horizon + 1), name='year')
+    intervals = pd.concat({'yearly_revenue': pd.DataFrame(np.percentile(yearly, percentiles, axis=0).T, index=years, columns=list(percentiles)),
+                           'disc_cumulated_revenue': pd.DataFrame(np.percentile(disc_cumulated, percentiles, axis=0).T, index=years, columns=list(percentiles))},
+                          axis=1, names=['measure', 'percentile'])
+    return intervals, pd.Series(np.percentile(worth, percentiles), index=pd.Index(list(percentiles), name='percentile'), name='database_value')
@@ -0,0 +1,122 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    CUBE - PRECOMPUTED PURCHASE AGGREGATES
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+import pandas as pd
+import numpy as np
+from purchases import purchase_days, purchase_amounts
+from clv import align_codes, snapshot_codes
+from segmentation import SEGMENTS
+from instrument import traced
+
+
+# One row per (year, month, segment) with at least one purchase
+# Sums of squares allow variances to be derived; counts, sums and sums of
+# squares add up and minima and maxima combine, so any coarser summary (per
+# year, per segment) and any update with new purchases come from the cube alone
+CUBE_MEASURES = ['count', 'sum', 'sumsq', 'min', 'max']
+
+
+# --- BUILDING THE CUBE ------------------------------------
+
+
+# Aggregate purchases by year, month and segment in one pass
+# 'segments' gives the segment of each customer: a customers frame with
+# customer_id and segment, or a pair (customer ids, codes); without it all
+# purchases fall in the segment 'all'. Purchases of customers with no segment
+# get a missing segment
+@traced('cube')
+def build_cube(data, segments=None, names=SEGMENTS):
+    month = purchase_days(data).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    amount = purchase_amounts(data)
+    if segments is None:
+        names = ['all']
+        code = np.zeros(len(month), dtype=np.int64)
+    else:
+        ids, codes = snapshot_codes(segments, names)
+        code = align_codes(np.asarray(data['customer_id']), ids, codes)
+    if len(month) == 0:
+        return empty_cube(names)
+    k = len(names) + 1
+    first_month = month.min()
+    key = (month - first_month) * k + (code + 1)
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+    starts = np.flatnonzero(np.r_[True, sorted_key[1:] != sorted_key[:-1]])
+    cells = sorted_key[starts]
+    group = np.repeat(np.arange(len(cells)), np.diff(np.r_[starts, len(key)]))
+    sorted_amount = amount[order]
+    months = cells // k + first_month
+    return pd.DataFrame({'year': months // 12 + 1970,
+                         'month': months % 12 + 1,
+                         'segment': pd.Categorical.from_codes(cells % k - 1, categories=names),
+                         'count': np.bincount(group, minlength=len(cells)).astype(np.int64),
+                         'sum': np.bincount(group, weights=sorted_amount, minlength=len(cells)),
+                         'sumsq': np.bincount(group, weights=sorted_amount ** 2, minlength=len(cells)),
+                         'min': np.minimum.reduceat(sorted_amount, starts),
+                         'max': np.maximum.reduceat(sorted_amount, starts)})
+
+
+# Cube with no purchase
+def empty_cube(names):
+    return pd.DataFrame({'year': np.empty(0, dtype=np.int64), 'month': np.empty(0, dtype=np.int64),
+                         'segment': pd.Categorical([], categories=names),
+                         'count': np.empty(0, dtype=np.int64), 'sum': np.empty(0), 'sumsq': np.empty(0),
+                         'min': np.empty(0), 'max': np.empty(0)})
+
+
+# Fold new purchases into an existing cube, without touching the old purchases
+@traced('cube_update')
+def update_cube(cube, new_data, segments=None):
+    names = list(cube.segment.cat.categories)
+    new_cube = build_cube(new_data, segments, names)
+    both = pd.concat([cube, new_cube], ignore_index=True)
+    both['segment'] = pd.Categorical(both.segment, categories=names)
+    merged = both.groupby(['year', 'month', 'segment'], observed=True, dropna=False, sort=True).agg(
+        {'count': 'sum', 'sum': 'sum', 'sumsq': 'sum', 'min': 'min', 'max': 'max'})
+    return merged.reset_index()
+
+
+# --- PERSISTING THE CUBE ----------------------------------
+
+
+# Save the cube to a .npz file, segments stored as codes plus their names
+def save_cube(cube, path):
+    np.savez(path, year=cube.year.values, month=cube.month.values, segment=cube.segment.cat.codes.values,
+             names=np.array(cube.segment.cat.categories, dtype=str),
+             **{m: cube[m].values for m in CUBE_MEASURES})
+
+
+def load_cube(path):
+    with np.load(path) as f:
+        names = list(f['names'])
+        cube = pd.DataFrame({'year': f['year'], 'month': f['month'],
+                             'segment': pd.Categorical.from_codes(f['segment'], categories=names)})
+        for m in CUBE_MEASURES:
+            cube[m] = f[m]
+    return cube
+
+
+# --- SUMMARIES --------------------------------------------
+
+
+# Roll the cube up to the given dimensions (e.g. ['year'], ['segment'], ['year', 'segment'])
+def summarize(cube, by):
+    rolled = cube.groupby(by, observed=True, sort=True).agg(
+        {'count': 'sum', 'sum': 'sum', 'sumsq': 'sum', 'min': 'min', 'max': 'max'})
+    rolled['avg_amount'] = rolled['sum'] / rolled['count']
+    rolled['std_amount'] = np.sqrt(np.maximum(rolled['sumsq'] / rolled['count'] - rolled['avg_amount'] ** 2, 0) * rolled['count'] / np.maximum(rolled['count'] - 1, 1))
+    return rolled
+
+
+# Number of purchases, average and total purchase amount per year, same as
+# the "all in one" query of module 0
+def yearly_summary(cube):
+    rolled = summarize(cube, ['year'])
+    return pd.DataFrame({'year_of_purchase': rolled.index.values,
+                         'counter': rolled['count'].values,
+                         'avg_amount': rolled['avg_amount'].values,
+                         'sum_amount': rolled['sum'].values})
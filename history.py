@@ -0,0 +1,165 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    HISTORY - PER-CUSTOMER PURCHASE HISTORY INDEX
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+# Purchases sorted once by customer and date, with the offset where each
+# customer's purchases start (CSR layout): the history of a customer is the
+# slice day[offsets[i]:offsets[i + 1]], and per-customer features are
+# segmented reductions over those slices, with no GROUP BY and no re-sort.
+# The index is saved next to the columnar cache of the purchase log, e.g.
+#
+#   history = load_history('purchases.txt')
+#   history.purchases(10)
+#   customers = history.features('2015-01-01', ['recency', 'frequency', 'mean_gap'])
+#
+import os
+import numpy as np
+import pandas as pd
+from purchases import REFERENCE_DATE, day_number, purchase_days, purchase_amounts, cache_dir, source_key, read_arrays, write_arrays, load_columns
+from rfm import RFM_COLUMNS, check_columns
+from instrument import traced
+
+
+# Columns that PurchaseHistory.features() knows how to produce: the RFM
+# columns plus the mean and longest gap (in days) between two purchases,
+# missing for customers with a single purchase
+HISTORY_COLUMNS = RFM_COLUMNS + ['mean_gap', 'max_gap']
+
+HISTORY_ARRAYS = ['ids', 'offsets', 'day', 'purchase_amount']
+
+
+class PurchaseHistory:
+
+    # ids: distinct customer ids (ascending), offsets: start of each
+    # customer's purchases plus the total number of purchases, day and
+    # purchase_amount: purchases sorted by customer and date
+    def __init__(self, ids, offsets, day, purchase_amount):
+        self.ids = ids
+        self.offsets = offsets
+        self.day = day
+        self.purchase_amount = purchase_amount
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Position of a customer in the index, None if it never purchased
+    def position(self, customer_id):
+        i = int(np.searchsorted(self.ids, customer_id))
+        if i < len(self.ids) and self.ids[i] == customer_id:
+            return i
+        return None
+
+    # Slice of the sorted purchases of one customer
+    def span(self, customer_id):
+        i = self.position(customer_id)
+        if i is None:
+            return slice(0, 0)
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    # Purchases of one customer, oldest first
+    def purchases(self, customer_id):
+        s = self.span(customer_id)
+        return pd.DataFrame({'customer_id': np.full(s.stop - s.start, customer_id, dtype=self.ids.dtype),
+                             'purchase_amount': purchase_amounts({'purchase_amount': self.purchase_amount[s]}),
+                             'date_of_purchase': np.asarray(self.day[s]).astype('datetime64[D]').astype('datetime64[ns]')})
+
+    # Days between consecutive purchases of one customer
+    def gaps(self, customer_id):
+        return np.diff(np.asarray(self.day[self.span(customer_id)]).astype(np.int64))
+
+    # Customer features as of a date, from the purchases made strictly before
+    # it; features(as_of) is compute_customers(data, offset) for
+    # as_of = reference date - offset days, with the same layout
+    @traced('history_features')
+    def features(self, as_of=REFERENCE_DATE, columns=('recency', 'first_purchase', 'frequency', 'amount')):
+        check_columns(columns, HISTORY_COLUMNS, 'history')
+        as_of = day_number(as_of)
+        day = np.asarray(self.day).astype(np.int64)
+        starts = np.asarray(self.offsets[:-1], dtype=np.int64)
+        if len(starts) == 0:
+            return pd.DataFrame({'customer_id': self.ids[:0], **{c: np.empty(0) for c in columns}})
+        # Purchases are sorted by date within a customer, so the purchases
+        # before the date are a prefix of each slice
+        before = day < as_of
+        frequency = np.add.reduceat(before, starts).astype(np.int64)
+        keep = frequency > 0
+        last = starts + frequency - 1
+        values = {'recency': lambda: as_of - day[last],
+                  'first_purchase': lambda: as_of - day[starts],
+                  'frequency': lambda: frequency}
+        if any(c in columns for c in ['amount', 'avg_amount', 'max_amount']):
+            amount = purchase_amounts({'purchase_amount': self.purchase_amount})
+            total = np.add.reduceat(np.where(before, amount, 0), starts)
+            average = total / np.maximum(frequency, 1)
+            values.update({'amount': lambda: average, 'avg_amount': lambda: average,
+                           'max_amount': lambda: np.maximum.reduceat(np.where(before, amount, -np.inf), starts)})
+        if 'mean_gap' in columns or 'max_gap' in columns:
+            # gap[i] is the gap before purchase i, 0 for the first purchase of a customer
+            gap = np.r_[0, np.diff(day)]
+            gap[starts] = 0
+            values.update({'mean_gap': lambda: np.where(frequency > 1, (day[last] - day[starts]) / np.maximum(frequency - 1, 1), np.nan),
+                           'max_gap': lambda: np.where(frequency > 1, np.maximum.reduceat(np.where(before, gap, 0), starts), np.nan)})
+        customers = pd.DataFrame({'customer_id': self.ids[keep]})
+        for c in columns:
+            customers[c] = values[c]()[keep]
+        return customers
+
+
+# --- BUILDING THE INDEX -----------------------------------
+
+
+# Sort the purchases of a frame (full or compact, see purchases.py) or of
+# typed columns by customer and date
+@traced('history')
+def build_history(data):
+    customer_id = np.asarray(data['customer_id'])
+    day = np.asarray(data['day']) if 'day' in data else purchase_days(data).astype(np.int32)
+    order = np.lexsort((day, customer_id))
+    sorted_id = customer_id[order]
+    if len(order):
+        starts = np.flatnonzero(np.r_[True, sorted_id[1:] != sorted_id[:-1]])
+    else:
+        starts = np.empty(0, dtype=np.intp)
+    return PurchaseHistory(sorted_id[starts], np.r_[starts, len(order)].astype(np.int64),
+                           day[order], np.asarray(data['purchase_amount'])[order])
+
+
+# --- PERSISTING THE INDEX ---------------------------------
+
+
+# The index lives in the cache of the purchase log, e.g. purchases.txt.cache/history/
+def history_dir(path):
+    return os.path.join(cache_dir(path), 'history')
+
+
+# Saved like the columnar cache, see purchases.write_arrays(); 'key' is the
+# source key of the purchase log the history was built from
+def save_history(history, path, key):
+    write_arrays(history_dir(path), {a: getattr(history, a) for a in HISTORY_ARRAYS}, key)
+
+
+# Memory-map the saved index, or return None if it is missing or stale
+def read_history(path, verify_hash=False):
+    arrays = read_arrays(history_dir(path), HISTORY_ARRAYS, path, verify_hash)
+    return PurchaseHistory(*[arrays[a] for a in HISTORY_ARRAYS]) if arrays is not None else None
+
+
+# Return the history index of a purchase log, memory-mapped when it was saved
+# for this version of the file, built from the cached columns (and saved) otherwise
+def load_history(path='purchases.txt', cache=True, verify_hash=False):
+    if cache:
+        history = read_history(path, verify_hash)
+        if history is not None:
+            return history
+    key = source_key(path, verify_hash) if cache else None
+    history = build_history(load_columns(path, cache, verify_hash))
+    if cache:
+        try:
+            save_history(history, path, key)
+        except OSError:
+            pass
+    return history
@@ -0,0 +1,286 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    INCREMENTAL - DAILY UPDATES OF CUSTOMERS, SEGMENTS, SCORES
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+# A persistent per-customer state (first and last purchase day, number of
+# purchases, sum and max of amounts, revenue per year, segment and scores)
+# that absorbs new purchases and moves its reference date forward without
+# going back to the purchase log, e.g.
+#
+#   python incremental.py init --input purchases.txt --state state.npz --models models.json
+#   python incremental.py update --state state.npz --input 2016-01-01.txt --reference-date 2016-01-02
+#
+# Purchases are folded in by a streaming.CustomerAccumulator as of a fixed
+# origin, so recency and first_purchase are derived from the current
+# reference date instead of being baked in. After a batch
+# of purchases or a new reference date, refresh() re-segments and rescores
+# only the customers that may have changed:
+# - customers with new purchases
+# - customers whose recency or first_purchase crosses a threshold of the
+#   segment rules between the old and the new reference date
+# Model terms linear in recency or first_purchase are split into a part
+# that depends on the customer's purchase days and a shift common to every
+# customer, so moving the date changes no stored score; models with other
+# date terms (e.g. log(recency)) are rescored for everyone when the date moves
+#
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from purchases import REFERENCE_DATE, day_number, purchase_days, purchase_amounts, parse_purchases, load_purchases
+from rfm import RFM_COLUMNS
+from streaming import CustomerAccumulator
+from segmentation import SEGMENTS, segment_codes, rule_columns
+from scoring import parse_term, linear_predictor
+from instrument import traced
+
+
+# Columns derived from the purchase days and the reference date
+DATE_COLUMNS = ['recency', 'first_purchase']
+
+STATE_ARRAYS = ['recency', 'first_purchase', 'frequency', 'total', 'max_amount']
+
+# Purchases are accumulated (see streaming.CustomerAccumulator) as of a fixed
+# origin after any purchase date, so every purchase is kept whatever the
+# reference date; recency and first_purchase as of the reference date are
+# the accumulated ones minus the days from the reference date to the origin
+ORIGIN = '9999-12-31'
+ORIGIN_DAY = day_number(ORIGIN)
+
+
+# Sum of the coefficients of the terms linear in a date column, and whether
+# the model has other (non-linear) date terms
+def date_terms(model):
+    linear, other = 0.0, False
+    for t, b in zip(*model):
+        transform, column = parse_term(t)
+        if column in DATE_COLUMNS:
+            if transform is None:
+                linear += b
+            else:
+                other = True
+    return linear, other
+
+
+class CustomerState:
+
+    def __init__(self, reference_date=REFERENCE_DATE, models=None, evaluate=segment_codes, segments=SEGMENTS):
+        self.reference_day = day_number(reference_date)
+        self.models = models
+        self.evaluate = evaluate
+        self.segments = segments
+        self.acc = CustomerAccumulator(offsets=(0,), years=None, reference_date=ORIGIN)
+        self.codes = np.empty(0, dtype=np.int8)
+        self.eta = {'prob': np.empty(0), 'amount': np.empty(0)}
+        self.stale = np.empty(0, dtype=bool)
+
+    @property
+    def ids(self):
+        return self.acc.ids
+
+    # Accumulated RFM state as of the origin, see STATE_ARRAYS
+    @property
+    def state(self):
+        return self.acc.state[0]
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Fold a batch of purchases (a frame, full or compact, or typed columns)
+    # into the state; the customers of the batch become stale
+    # Like build_state(), the state only holds purchases made strictly before
+    # the reference date: advance() past a day before adding its purchases
+    @traced('incremental_add')
+    def add(self, data):
+        customer_id = np.asarray(data['customer_id'])
+        if len(customer_id) == 0:
+            return self
+        day = purchase_days(data)
+        late = int(np.count_nonzero(day >= self.reference_day))
+        if late:
+            raise ValueError('%d purchases are on or after the reference date %s, advance the reference date past them first'
+                             % (late, np.datetime64(self.reference_day, 'D')))
+        known = self.ids
+        self.acc.add({'customer_id': customer_id, 'purchase_amount': purchase_amounts(data), 'day': day})
+        if len(self.ids) > len(known):
+            # Customers seen for the first time have no segment or scores yet
+            pos = np.searchsorted(self.ids, known)
+            codes, stale = np.full(len(self.ids), -1, dtype=np.int8), np.ones(len(self.ids), dtype=bool)
+            codes[pos], stale[pos] = self.codes, self.stale
+            self.codes, self.stale = codes, stale
+            for name, eta in self.eta.items():
+                self.eta[name] = np.zeros(len(self.ids))
+                self.eta[name][pos] = eta
+        self.stale[np.searchsorted(self.ids, customer_id)] = True
+        return self
+
+    # Move the reference date forward; customers whose segment may change
+    # become stale
+    def advance(self, reference_date):
+        new_day = day_number(reference_date)
+        if new_day < self.reference_day:
+            raise ValueError('the reference date can only move forward')
+        if new_day == self.reference_day:
+            return self
+        # Date columns only grow, a column crosses threshold t when old <= t <= new
+        for column in DATE_COLUMNS:
+            since = self.state[column]
+            for t in getattr(self.evaluate, 'thresholds', {}).get(column, []):
+                self.stale |= (since - (ORIGIN_DAY - self.reference_day) <= t) & (since - (ORIGIN_DAY - new_day) >= t)
+        if self.models is not None and any(date_terms(m)[1] for m in self.models):
+            self.stale[:] = True
+        self.reference_day = new_day
+        return self
+
+    # Customer columns (see rfm.RFM_COLUMNS) as of the reference date, for
+    # all customers or for the positions 'pos'
+    def columns(self, pos=slice(None), columns=RFM_COLUMNS):
+        state = {k: v[pos] for k, v in self.state.items()}
+        shift = ORIGIN_DAY - self.reference_day
+        average = state['total'] / np.maximum(state['frequency'], 1)
+        values = {'recency': lambda: state['recency'] - shift,
+                  'first_purchase': lambda: state['first_purchase'] - shift,
+                  'frequency': lambda: state['frequency'],
+                  'amount': lambda: average,
+                  'avg_amount': lambda: average,
+                  'max_amount': lambda: state['max_amount']}
+        return {c: values[c]() for c in columns}
+
+    # Re-segment and rescore the stale customers; returns how many there were
+    @traced('incremental_refresh')
+    def refresh(self):
+        pos = np.flatnonzero(self.stale)
+        if len(pos) == 0:
+            return 0
+        columns = self.columns(pos)
+        self.codes[pos] = self.evaluate(rule_columns(columns, self.evaluate.variables))
+        if self.models is not None:
+            # Separable models are stored without the common shift (date
+            # columns as minus the purchase day), see scores()
+            shifted = dict(columns, recency=self.state['recency'][pos].astype(np.float64) - ORIGIN_DAY,
+                           first_purchase=self.state['first_purchase'][pos].astype(np.float64) - ORIGIN_DAY)
+            for name, model in zip(['prob', 'amount'], self.models):
+                linear, other = date_terms(model)
+                self.eta[name][pos] = linear_predictor(model, columns if other else shifted)
+        self.stale[pos] = False
+        return len(pos)
+
+    # Same output as rfm.compute_customers(data, 0, columns) on the whole log
+    def customers(self, columns=('recency', 'first_purchase', 'frequency', 'amount')):
+        customers = pd.DataFrame({'customer_id': self.ids})
+        for c, v in self.columns(columns=columns).items():
+            customers[c] = v
+        return customers
+
+    # Same output as rfm.compute_revenue(data, year)
+    def revenue(self, year):
+        return self.acc.revenue(year)
+
+    # Segment of every customer, as segmentation.segment_customers()
+    def segment(self):
+        if self.stale.any():
+            raise ValueError('%d customers are stale, call refresh() first' % self.stale.sum())
+        return pd.Series(pd.Categorical.from_codes(self.codes, categories=self.segments, ordered=True), name='segment')
+
+    # Customers with their segment and scores, as scoring.score_customers()
+    def scores(self, columns=('recency', 'first_purchase', 'frequency', 'avg_amount', 'max_amount')):
+        from scipy.special import expit
+        if self.models is None:
+            raise ValueError('the state has no models to score with')
+        customers = self.customers(columns)
+        customers['segment'] = self.segment().values
+        eta = {}
+        for name, model in zip(['prob', 'amount'], self.models):
+            linear, other = date_terms(model)
+            eta[name] = self.eta[name] + (0 if other else linear * self.reference_day)
+        customers['prob_predicted'] = expit(eta['prob'])
+        customers['revenue_predicted'] = np.exp(eta['amount'])
+        customers['score_predicted'] = customers.prob_predicted * customers.revenue_predicted
+        return customers
+
+    # Save the state to a .npz file; the segment rules are not saved
+    def save(self, path):
+        years = sorted(self.acc.revenue_state)
+        revenue = [self.acc.revenue_state[y] for y in years]
+        arrays = {'ids': self.ids, 'codes': self.codes, 'stale': self.stale,
+                  'reference_day': np.int64(self.reference_day), 'segments': np.array(self.segments, dtype=str),
+                  'years': np.array(years, dtype=np.int64),
+                  'revenue': np.array([r for r, _ in revenue]).reshape(len(years), len(self.ids)),
+                  'seen': np.array([seen for _, seen in revenue], dtype=bool).reshape(len(years), len(self.ids))}
+        arrays.update({'state_' + k: v for k, v in self.state.items()})
+        arrays.update({'eta_' + k: v for k, v in self.eta.items()})
+        if self.models is not None:
+            for name, (terms, coef) in zip(['prob', 'amount'], self.models):
+                arrays.update({name + '_terms': np.array(terms, dtype=str), name + '_coef': coef})
+        np.savez(path, **arrays)
+
+
+# Load a state saved by CustomerState.save()
+def load_state(path, evaluate=segment_codes):
+    with np.load(path) as f:
+        models = None
+        if 'prob_terms' in f:
+            models = tuple((list(f[name + '_terms']), f[name + '_coef']) for name in ['prob', 'amount'])
+        state = CustomerState(models=models, evaluate=evaluate, segments=list(f['segments']))
+        state.reference_day = int(f['reference_day'])
+        state.codes, state.stale = f['codes'], f['stale']
+        state.acc.ids = f['ids']
+        state.acc.state[0] = {k: f['state_' + k] for k in STATE_ARRAYS}
+        state.acc.revenue_state = {int(y): (r, seen) for y, r, seen in zip(f['years'], f['revenue'], f['seen'])}
+        state.eta = {k: f['eta_' + k] for k in ['prob', 'amount']}
+    return state
+
+
+# Build the state of a purchase log (a frame, full or compact) as of a
+# reference date, from the purchases made strictly before it
+@traced('incremental_build')
+def build_state(data, reference_date=REFERENCE_DATE, models=None, evaluate=segment_codes, segments=SEGMENTS):
+    state = CustomerState(reference_date, models, evaluate, segments)
+    state.add(data[purchase_days(data) < state.reference_day])
+    state.refresh()
+    return state
+
+
+# --- COMMAND LINE -----------------------------------------
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain customer segments and scores incrementally')
+    parser.add_argument('command', choices=['init', 'update'])
+    parser.add_argument('--input', default='purchases.txt', help='init: full purchase log, update: new purchases')
+    parser.add_argument('--state', default='state.npz', help='state file, written by init and updated by update')
+    parser.add_argument('--models', help='JSON file of fitted models (see pipeline.py fit)')
+    parser.add_argument('--reference-date', help='init: default 2016-01-01, update: new reference date, after the new purchases (default: unchanged)')
+    parser.add_argument('--output', help='CSV file for the segments and scores of all customers')
+    args = parser.parse_args(argv)
+
+    if args.command == 'init':
+        models = None
+        if args.models:
+            from pipeline import load_models
+            models = load_models(args.models)
+        state = build_state(load_purchases(args.input, compact=True), args.reference_date or REFERENCE_DATE, models)
+        refreshed = len(state)
+    else:
+        state = load_state(args.state)
+        try:
+            if args.reference_date:
+                state.advance(args.reference_date)
+            state.add(parse_purchases(args.input))
+        except ValueError as exc:
+            parser.error(str(exc))
+        refreshed = state.refresh()
+    state.save(args.state)
+    print('%d customers, %d refreshed, reference date %s' % (len(state), refreshed, np.datetime64(state.reference_day, 'D')))
+    if args.output:
+        customers = state.scores() if state.models is not None else state.customers().assign(segment=state.segment().values)
+        customers.to_csv(args.output, index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
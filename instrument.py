@@ -0,0 +1,163 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    INSTRUMENT - PER-STAGE TIMING AND MEMORY TRACES
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+# Opt-in: nothing is recorded unless tracing is enabled, either with
+#   ANALYTICS_TRACE=trace.json [ANALYTICS_PROFILE=profiles/] python module3.py
+# or from python with instrument.enable('trace.json', profile_dir='profiles').
+# Each stage records wall time, CPU time, peak RSS, RSS growth and row count;
+# the JSON trace is written when the process exits (or by write_trace()).
+# With a profile directory, every stage also dumps a cProfile file.
+#
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+import functools
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+TRACE = {'enabled': False, 'path': None, 'profile_dir': None, 'stages': [], 'depth': 0, 'at_exit': False}
+
+
+# --- ENABLING TRACES --------------------------------------
+
+
+# Start recording stages; with a path the trace is written there at exit
+def enable(path=None, profile_dir=None):
+    TRACE.update({'enabled': True, 'path': path, 'profile_dir': profile_dir})
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+    if path and not TRACE['at_exit']:
+        atexit.register(write_trace)
+        TRACE['at_exit'] = True
+
+
+def disable():
+    TRACE['enabled'] = False
+
+
+def enabled():
+    return TRACE['enabled']
+
+
+# Write the stages recorded so far as JSON
+def write_trace(path=None):
+    path = path or TRACE['path']
+    if path is None:
+        return None
+    with open(path, 'w') as f:
+        json.dump({'pid': os.getpid(), 'argv': sys.argv, 'stages': TRACE['stages']}, f, indent=1)
+    return path
+
+
+# --- MEMORY -----------------------------------------------
+
+
+# Peak resident set size of the process so far, in MB
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+# Current resident set size, in MB (Linux only)
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# --- STAGES -----------------------------------------------
+
+
+class NoStage:
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_STAGE = NoStage()
+
+
+# A traced stage; set .rows inside the block to record a row count
+class Stage:
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self.depth = TRACE['depth']
+        TRACE['depth'] += 1
+        self.rss = rss_mb()
+        self.profile = None
+        # cProfile cannot nest, nested stages are part of the outer profile
+        if TRACE['profile_dir'] and self.depth == 0:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.wall, self.cpu = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall, cpu = time.perf_counter() - self.wall, time.process_time() - self.cpu
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(os.path.join(TRACE['profile_dir'], '%03d-%s.prof' % (len(TRACE['stages']), self.name)))
+        TRACE['depth'] -= 1
+        rss = rss_mb()
+        TRACE['stages'].append({'stage': self.name, 'depth': self.depth, 'start': self.wall,
+                                'wall_s': wall, 'cpu_s': cpu, 'peak_rss_mb': peak_rss_mb(),
+                                'rss_growth_mb': rss - self.rss if rss is not None and self.rss is not None else None,
+                                'rows': self.rows, 'error': exc_type.__name__ if exc_type else None})
+        return False
+
+
+# Context manager for a stage of a script, e.g.
+#   with stage('model_fit') as s:
+#       fit = model.fit()
+#       s.rows = fit.nobs
+def stage(name, rows=None):
+    if not TRACE['enabled']:
+        return NO_STAGE
+    return Stage(name, rows)
+
+
+# Decorator tracing every call of a function as a stage; the row count is
+# the length of the result (the first element of a tuple result)
+def traced(name):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not TRACE['enabled']:
+                return fn(*args, **kwargs)
+            with Stage(name) as s:
+                result = fn(*args, **kwargs)
+                first = result[0] if isinstance(result, tuple) and result else result
+                try:
+                    s.rows = len(first)
+                except TypeError:
+                    pass
+            return result
+        return wrapper
+    return decorate
+
+
+if os.environ.get('ANALYTICS_TRACE'):
+    enable(os.environ['ANALYTICS_TRACE'], os.environ.get('ANALYTICS_PROFILE'))
@@ -8,32 +8,31 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from pandasql import sqldf
+from purchases import load_purchases
+from rfm import compute_customers
 from sklearn.preprocessing import scale
 from scipy.spatial.distance import pdist
-from scipy.cluster.hierarchy import linkage, dendrogram, cut_tree
+from scipy.cluster.hierarchy import dendrogram
+from clustering import ward_linkage, cut_customers, profile_cuts
 
 
 # --- COMPUTING RECENCY, FREQUENCY, MONETARY VALUE ---------
 
 
 # Load text file into local variable called 'data'
-data = pd.read_table('purchases.txt', header = None)
-
-# Add headers and interpret the last column as a date, extract year of purchase
-data.columns = ['customer_id', 'purchase_amount', 'date_of_purchase']
-data['date_of_purchase'] = pd.to_datetime(data.date_of_purchase)
-data['days_since'] = (pd.Timestamp('2016-01-01') - data['date_of_purchase']).dt.days
+# Headers, date of purchase, year of purchase and days since are added by load_purchases(),
+# the parsed columns are cached next to the file and memory-mapped on later runs
+data = load_purchases('purchases.txt')
 
 
 # Display the data after transformation
 data.head()
 data.describe()
 
-# Compute key marketing indicators using SQL language
+# Compute key marketing indicators in a single group-by pass
 
 # Compute recency, frequency, and average purchase amount
-customers = sqldf("SELECT customer_id, MIN(days_since) AS 'recency', COUNT(*) AS 'frequency', AVG(purchase_amount) AS 'amount' FROM data GROUP BY 1", globals())
+customers = compute_customers(data, columns=['recency', 'frequency', 'amount'])
 
 # Explore the data
 customers.head()
@@ -71,27 +70,34 @@ new_data.head()
 # This will likely generate an error on most machines
 # d = dist(new_data)
 
-# Take a 10% sample
-customers_sample = customers.iloc[::10, :]
-new_data_sample  = new_data.iloc[::10, :]
-
-# Compute distance metrics on standardized data
-#d = pdist(new_data_sample)
-#not needed for ward
+# Instead, condense the customers into 1000 micro-clusters (bounded memory,
+# linear time), then perform Ward clustering on the centroids weighted by size
+c, leaves = ward_linkage(new_data, n_centroids=1000)
 
-# Perform hierarchical clustering on distance metrics
-c = linkage(new_data_sample, method='ward')
+# Plot the dendogram, down to 30 branches
+dendrogram(c, truncate_mode='lastp', p=30)
 
-# Plot the dendogram
-dendrogram(c, get_leaves=True, labels=None)
-
-# Cut at 9 segments
-members = pd.DataFrame(cut_tree(c, n_clusters = 9), index=new_data_sample.index, columns=['ClusterNumber'])
+# Cut at 9 segments, every customer gets assigned to one
+members = cut_customers(c, leaves, n_clusters = 9, index=new_data.index)
 
 # Show 30 first customers, frequency table
 members.iloc[0:30]
 members.ClusterNumber.value_counts(sort=False)
 
 # Show profile of each segment
-customers_sample_new = customers_sample.set_index(customers_sample.customer_id).iloc[:,1:4]
-customers_sample_new.groupby(members.ClusterNumber).mean()
+customers_new = customers.set_index(customers.customer_id).iloc[:,1:4]
+customers_new.groupby(members.ClusterNumber).mean()
+
+
+# --- CHOOSING THE NUMBER OF SEGMENTS ---------------------
+
+
+# Cut the same tree at 2 to 15 segments at once: memberships, profile of
+# each segment and within-segment sum of squares for every number of segments
+members_k, profiles, wss = profile_cuts(c, leaves, new_data, range(2, 16), profile=customers_new)
+
+# Look for an elbow in the within-segment variance curve
+wss.plot(kind='line', marker='o')
+
+# Show profile of each segment for 9 segments, same as above
+profiles.loc[9]
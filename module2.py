@@ -7,29 +7,28 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from pandasql import sqldf
+from purchases import load_purchases
+from rfm import compute_customers, compute_revenue
+from segmentation import segment_customers
+from cube import build_cube, summarize
 
 
 # --- COMPUTING RECENCY, FREQUENCY, MONETARY VALUE ---------
 
 
 # Load text file into local variable called 'data'
-data = pd.read_table('purchases.txt', header = None)
-
-# Add headers and interpret the last column as a date, extract year of purchase
-data.columns = ['customer_id', 'purchase_amount', 'date_of_purchase']
-data['date_of_purchase'] = pd.to_datetime(data.date_of_purchase)
-data['year_of_purchase'] = pd.DatetimeIndex(data['date_of_purchase']).year
-data['days_since'] = (pd.Timestamp('2016-01-01') - data['date_of_purchase']).dt.days
+# Headers, date of purchase, year of purchase and days since are added by load_purchases(),
+# the parsed columns are cached next to the file and memory-mapped on later runs
+data = load_purchases('purchases.txt')
 
 # Display the data after transformation
 data.head()
 data.describe()
 
-# Compute key marketing indicators using SQL language
+# Compute key marketing indicators in a single group-by pass
 
 # Compute recency, frequency, and average purchase amount
-customers_2015 = sqldf("SELECT customer_id, MIN(days_since) AS 'recency', MAX(days_since) AS 'first_purchase', COUNT(*) AS 'frequency', AVG(purchase_amount) AS 'amount' FROM data GROUP BY 1", globals())
+customers_2015 = compute_customers(data)
 
 # Explore the data
 customers_2015.head()
@@ -73,24 +72,9 @@ x=customers_2015.iloc[:,1:5]
 x.groupby(customers_2015.segment).mean()  #aggregate
 
 
-# Complete segment solution using which, and exploiting previous test as input
-customers_2015['segment']=np.empty(len(customers_2015), dtype=object)
-customers_2015.segment.loc[customers_2015.recency>3*365] = 'inactive'
-customers_2015.segment.loc[(customers_2015.recency<=3*365) & (customers_2015.recency>2*365)] = 'cold'
-customers_2015.segment.loc[(customers_2015.recency<=2*365) & (customers_2015.recency>1*365)] = 'warm'
-customers_2015.segment.loc[customers_2015.recency<1*365] = 'active'
-customers_2015.segment.loc[(customers_2015.segment=='warm') & (customers_2015.first_purchase<=2*365)] = 'new warm'
-customers_2015.segment.loc[(customers_2015.segment=='warm') & (customers_2015.amount<100)] = 'warm low value'
-customers_2015.segment.loc[(customers_2015.segment=='warm') & (customers_2015.amount>=100)] = 'warm high value'
-customers_2015.segment.loc[(customers_2015.segment=='active') & (customers_2015.first_purchase<=365)] = 'new active'
-customers_2015.segment.loc[(customers_2015.segment=='active') & (customers_2015.amount<100)] = 'active low value'
-customers_2015.segment.loc[(customers_2015.segment=='active') & (customers_2015.amount>=100)] = 'active high value'
-x=customers_2015.iloc[:,1:5]
-x.groupby(customers_2015.segment).mean()  #aggregate
-
-
-# Re-order factor in a way that makes sense
-customers_2015.segment = customers_2015.segment.astype('category').cat.reorder_categories(['inactive', 'cold', 'warm high value', 'warm low value', 'new warm', 'active high value', 'active low value', 'new active'], ordered=True)
+# Complete segment solution, the rules are written once in segmentation.SEGMENT_RULES
+# and evaluated in a single vectorized pass into an ordered factor
+customers_2015['segment'] = segment_customers(customers_2015)
 x=customers_2015.iloc[:,1:5]
 x.groupby(customers_2015.segment).mean()  #aggregate
 
@@ -98,29 +82,15 @@ x.groupby(customers_2015.segment).mean()  #aggregate
 # --- SEGMENTING A DATABASE RETROSPECTIVELY ----------------
 
 
-# Compute key marketing indicators using SQL language
+# Compute key marketing indicators in a single group-by pass
+
+# Compute recency, frequency, and average purchase amount as of a year ago
+customers_2014 = compute_customers(data, offset=365)
 
-# Compute recency, frequency, and average purchase amount
-customers_2014 = sqldf("SELECT customer_id, MIN(days_since) - 365 AS 'recency', MAX(days_since) - 365 AS 'first_purchase', COUNT(*) AS 'frequency', AVG(purchase_amount) AS 'amount' FROM data WHERE days_since > 365 GROUP BY 1", globals())
-
-
-# Complete segment solution using which, and exploiting previous test as input
-customers_2014['segment']=np.empty(len(customers_2014), dtype=object)
-customers_2014.segment.loc[customers_2014.recency>3*365] = 'inactive'
-customers_2014.segment.loc[(customers_2014.recency<=3*365) & (customers_2014.recency>2*365)] = 'cold'
-customers_2014.segment.loc[(customers_2014.recency<=2*365) & (customers_2014.recency>1*365)] = 'warm'
-customers_2014.segment.loc[customers_2014.recency<1*365] = 'active'
-customers_2014.segment.loc[(customers_2014.segment=='warm') & (customers_2014.first_purchase<=2*365)] = 'new warm'
-customers_2014.segment.loc[(customers_2014.segment=='warm') & (customers_2014.amount<100)] = 'warm low value'
-customers_2014.segment.loc[(customers_2014.segment=='warm') & (customers_2014.amount>=100)] = 'warm high value'
-customers_2014.segment.loc[(customers_2014.segment=='active') & (customers_2014.first_purchase<=365)] = 'new active'
-customers_2014.segment.loc[(customers_2014.segment=='active') & (customers_2014.amount<100)] = 'active low value'
-customers_2014.segment.loc[(customers_2014.segment=='active') & (customers_2014.amount>=100)] = 'active high value'
-x=customers_2014.iloc[:,1:5]
-x.groupby(customers_2014.segment).mean()  #aggregate
 
-# Re-order factor in a way that makes sense
-customers_2014.segment = customers_2014.segment.astype('category').cat.reorder_categories(['inactive', 'cold', 'warm high value', 'warm low value', 'new warm', 'active high value', 'active low value', 'new active'], ordered=True)
+# Complete segment solution, the rules are written once in segmentation.SEGMENT_RULES
+# and evaluated in a single vectorized pass into an ordered factor
+customers_2014['segment'] = segment_customers(customers_2014)
 x=customers_2014.iloc[:,1:5]
 x.groupby(customers_2014.segment).mean()  #aggregate
 
@@ -136,7 +106,7 @@ x.groupby(customers_2014.segment).mean()  #aggregate
 
 # Compute how much revenue is generated by segments
 # Notice that people with no revenue in 2015 do NOT appear
-revenue_2015 = sqldf("SELECT customer_id, SUM(purchase_amount) AS 'revenue_2015' FROM data WHERE year_of_purchase = 2015 GROUP BY 1", globals())
+revenue_2015 = compute_revenue(data, 2015)
 revenue_2015.describe()
 
 # Merge 2015 customers and 2015 revenue (the wrong way)
@@ -162,3 +132,9 @@ r = x.groupby(customers_2014.segment).mean()  #aggregate
 r = r.sort_values(ascending=False)
 print(r)
 r.plot(kind='bar')
+
+
+# Purchases per year and segment (segment as of today), rolled up from an
+# aggregate cube of the purchases by year, month and segment
+cube = build_cube(data, customers_2015)
+summarize(cube, ['year', 'segment'])
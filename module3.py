@@ -7,7 +7,10 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from pandasql import sqldf
+from purchases import load_purchases
+from rfm import compute_customers, compute_revenue
+from scoring import extract_model, score_customers
+from instrument import stage
 import statsmodels.api as sm
 
 
@@ -15,21 +18,17 @@ import statsmodels.api as sm
 
 
 # Load text file into local variable called 'data'
-data = pd.read_table('purchases.txt', header = None)
+# Headers, date of purchase, year of purchase and days since are added by load_purchases(),
+# the parsed columns are cached next to the file and memory-mapped on later runs
+data = load_purchases('purchases.txt')
 
-# Add headers and interpret the last column as a date, extract year of purchase
-data.columns = ['customer_id', 'purchase_amount', 'date_of_purchase']
-data['date_of_purchase'] = pd.to_datetime(data.date_of_purchase)
-data['year_of_purchase'] = pd.DatetimeIndex(data['date_of_purchase']).year
-data['days_since'] = (pd.Timestamp('2016-01-01') - data['date_of_purchase']).dt.days
-
-# Compute key marketing indicators using SQL language
+# Compute key marketing indicators in a single group-by pass
 
 # Compute RFM variables as of a year ago
-customers_2014 = sqldf("SELECT customer_id, MIN(days_since) - 365 AS 'recency', MAX(days_since) - 365 AS 'first_purchase', COUNT(*) AS 'frequency', AVG(purchase_amount) AS 'avg_amount', MAX(purchase_amount) AS 'max_amount' FROM data WHERE days_since > 365 GROUP BY 1", globals())
+customers_2014 = compute_customers(data, offset=365, columns=['recency', 'first_purchase', 'frequency', 'avg_amount', 'max_amount'])
 
 # Compute revenues generated by customers in 2015
-revenue_2015 = sqldf("SELECT customer_id, SUM(purchase_amount) AS 'revenue_2015' FROM data WHERE year_of_purchase = 2015 GROUP BY 1", globals())
+revenue_2015 = compute_revenue(data, 2015)
 
 # Merge 2015 customers and 2015 revenue
 in_sample = pd.merge(customers_2014, revenue_2015, how='left')
@@ -46,7 +45,8 @@ in_sample.describe()
 
 # Calibrate probability model
 prob_model = sm.Logit.from_formula(b'active_2015 ~ recency + first_purchase + frequency + avg_amount + max_amount', in_sample)
-prob_model_fit = prob_model.fit()
+with stage('model_fit', len(in_sample)):
+    prob_model_fit = prob_model.fit()
 coef = prob_model_fit.params
 std = prob_model_fit.bse
 print(coef)
@@ -69,7 +69,8 @@ plt.scatter(in_sample.loc[z].revenue_2015, amount_model_fit.fittedvalues)
 
 # Re-calibrate the monetary model, using a log-transform (version 2)
 amount_model = sm.OLS.from_formula(b'log(revenue_2015) ~ log(avg_amount) + log(max_amount)', in_sample.loc[z])
-amount_model_fit = amount_model.fit()
+with stage('model_fit', len(z)):
+    amount_model_fit = amount_model.fit()
 amount_model_fit.summary()
 amount.model = lm(formula = log(revenue_2015) ~ log(avg_amount) + log(max_amount), data = in_sample[z, ])
 summary(amount.model)
@@ -82,12 +83,12 @@ plt.scatter(log(in_sample.loc[z].revenue_2015), amount_model_fit.fittedvalues)
 
 
 # Compute RFM variables as of today
-customers_2015 = sqldf("SELECT customer_id, MIN(days_since) AS 'recency', MAX(days_since) AS 'first_purchase', COUNT(*) AS 'frequency', AVG(purchase_amount) AS 'avg_amount', MAX(purchase_amount) AS 'max_amount' FROM data GROUP BY 1", globals())
+customers_2015 = compute_customers(data, columns=['recency', 'first_purchase', 'frequency', 'avg_amount', 'max_amount'])
 
 # Predict the target variables based on today's data
-customers_2015['prob_predicted'] = prob_model_fit.predict(customers_2015)
-customers_2015['revenue_predicted'] = exp(amount_model_fit.predict(customers_2015))
-customers_2015['score_predicted'] = customers_2015['prob_predicted'] * customers_2015['revenue_predicted']
+# The coefficients are extracted once and evaluated as dot products, chunk by chunk
+# (use n_jobs to spread the chunks over several processes)
+customers_2015 = score_customers(customers_2015, extract_model(prob_model_fit), extract_model(amount_model_fit))
 customers_2015.prob_predicted.describe()
 customers_2015.revenue_predicted.describe()
 customers_2015.score_predicted.describe()
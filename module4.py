@@ -7,74 +7,45 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from pandasql import sqldf
+from purchases import load_purchases
+from rfm import compute_panel, panel_slice, compute_revenue
+from segmentation import segment_snapshots
+from clv import transition_matrix, project_segments, database_value, simulate_clv
 
 
 # --- SEGMENT CUSTOMERS IN 2014 AND 2015 -------------------
 
 
 # Load text file into local variable called 'data'
-data = pd.read_table('purchases.txt', header = None)
+# Headers, date of purchase, year of purchase and days since are added by load_purchases(),
+# the parsed columns are cached next to the file and memory-mapped on later runs
+data = load_purchases('purchases.txt')
 
-# Add headers and interpret the last column as a date, extract year of purchase
-data.columns = ['customer_id', 'purchase_amount', 'date_of_purchase']
-data['date_of_purchase'] = pd.to_datetime(data.date_of_purchase)
-data['year_of_purchase'] = pd.DatetimeIndex(data['date_of_purchase']).year
-data['days_since'] = (pd.Timestamp('2016-01-01') - data['date_of_purchase']).dt.days
+# Compute RFM variables as of a year ago and as of today from a single sorted pass
+panel = compute_panel(data, ['2015-01-01', '2016-01-01'])
+customers_2014 = panel_slice(panel, '2015-01-01')
+customers_2015 = panel_slice(panel, '2016-01-01')
 
-# Invoke library to compute key marketing indicators using SQL language
-
-# Segment customers in 2015
-customers_2015 = sqldf("SELECT customer_id, MIN(days_since) AS 'recency', MAX(days_since) AS 'first_purchase', COUNT(*) AS 'frequency', AVG(purchase_amount) AS 'amount' FROM data GROUP BY 1", globals())
-
-customers_2015['segment']=np.empty(len(customers_2015), dtype=object)
-customers_2015.segment.loc[customers_2015.recency>3*365] = 'inactive'
-customers_2015.segment.loc[(customers_2015.recency<=3*365) & (customers_2015.recency>2*365)] = 'cold'
-customers_2015.segment.loc[(customers_2015.recency<=2*365) & (customers_2015.recency>1*365)] = 'warm'
-customers_2015.segment.loc[customers_2015.recency<1*365] = 'active'
-customers_2015.segment.loc[(customers_2015.segment=='warm') & (customers_2015.first_purchase<=2*365)] = 'new warm'
-customers_2015.segment.loc[(customers_2015.segment=='warm') & (customers_2015.amount<100)] = 'warm low value'
-customers_2015.segment.loc[(customers_2015.segment=='warm') & (customers_2015.amount>=100)] = 'warm high value'
-customers_2015.segment.loc[(customers_2015.segment=='active') & (customers_2015.first_purchase<=365)] = 'new active'
-customers_2015.segment.loc[(customers_2015.segment=='active') & (customers_2015.amount<100)] = 'active low value'
-customers_2015.segment.loc[(customers_2015.segment=='active') & (customers_2015.amount>=100)] = 'active high value'
-
-customers_2015.segment = customers_2015.segment.astype('category').cat.reorder_categories(['inactive', 'cold', 'warm high value', 'warm low value', 'new warm', 'active high value', 'active low value', 'new active'], ordered=True)
-
-
-# Segment customers in 2014
-customers_2014 = sqldf("SELECT customer_id, MIN(days_since) - 365 AS 'recency', MAX(days_since) - 365 AS 'first_purchase', COUNT(*) AS 'frequency', AVG(purchase_amount) AS 'amount' FROM data WHERE days_since > 365 GROUP BY 1", globals())
-
-customers_2014['segment']=np.empty(len(customers_2014), dtype=object)
-customers_2014.segment.loc[customers_2014.recency>3*365] = 'inactive'
-customers_2014.segment.loc[(customers_2014.recency<=3*365) & (customers_2014.recency>2*365)] = 'cold'
-customers_2014.segment.loc[(customers_2014.recency<=2*365) & (customers_2014.recency>1*365)] = 'warm'
-customers_2014.segment.loc[customers_2014.recency<1*365] = 'active'
-customers_2014.segment.loc[(customers_2014.segment=='warm') & (customers_2014.first_purchase<=2*365)] = 'new warm'
-customers_2014.segment.loc[(customers_2014.segment=='warm') & (customers_2014.amount<100)] = 'warm low value'
-customers_2014.segment.loc[(customers_2014.segment=='warm') & (customers_2014.amount>=100)] = 'warm high value'
-customers_2014.segment.loc[(customers_2014.segment=='active') & (customers_2014.first_purchase<=365)] = 'new active'
-customers_2014.segment.loc[(customers_2014.segment=='active') & (customers_2014.amount<100)] = 'active low value'
-customers_2014.segment.loc[(customers_2014.segment=='active') & (customers_2014.amount>=100)] = 'active high value'
-
-customers_2014.segment = customers_2014.segment.astype('category').cat.reorder_categories(['inactive', 'cold', 'warm high value', 'warm low value', 'new warm', 'active high value', 'active low value', 'new active'], ordered=True)
+# Segment both years in a single vectorized pass, see segmentation.SEGMENT_RULES
+customers_2014['segment'], customers_2015['segment'] = segment_snapshots([customers_2014, customers_2015])
 
 
 # --- COMPUTE TRANSITION MATRIX ----------------------------
 
 
 # Compute transition matrix
-new_data = pd.merge(customers_2014, customers_2015, on='customer_id', how='left')
-new_data.head()
-
-transition = pd.crosstab(new_data.segment_x, new_data.segment_y)
+# Counts moves between segment codes, rows and columns in the segments order
+transition = transition_matrix([customers_2014, customers_2015], normalize=False)
 print(transition)
-# I don't know how to get the col/row name order right...
 
 # Divide each row by its sum
-transition = transition.apply(lambda r: r/r.sum(), axis=1)
+transition = transition.div(transition.sum(axis=1), axis=0).fillna(0)
 print(transition)
 
+# Customers of 2014 side by side with their 2015 segment
+new_data = pd.merge(customers_2014, customers_2015, on='customer_id', how='left')
+new_data.head()
+
 
 # --- USE TRANSITION MATRIX TO MAKE PREDICTIONS ------------
 
@@ -86,9 +57,7 @@ segments = pd.DataFrame(segments, columns=arange(2015,2026), index=customers_201
 print(segments)
 
 # Compute for each an every period
-for i in range(2016, 2026):
-    segments[i] = segments[i-1].dot(transition)
-    segments[i] = segments[i].fillna(0)
+segments = project_segments(segments[2015], transition, horizon=10, start=2015)
 
 
 # Plot inactive, active high value customers over time
@@ -139,3 +108,33 @@ disc_cumulated_revenue.plot(kind='bar')
 
 # What is the database worth?
 print(disc_cumulated_revenue[2025] - yearly_revenue[2015])
+
+
+# --- SENSITIVITY OF THE DATABASE VALUE --------------------
+
+
+# Value of the database for a grid of discount rates and horizons at once,
+# the 'inf' column is the infinite horizon value, from a linear solve
+revenue_per_customer = pd.Series([0, 0, 0, 0, 0, 323.57, 52.31, 79.17], index=customers_2015.segment.values.categories)
+database_values = database_value(segments[2015], transition, revenue_per_customer, discount_rates=np.arange(0.02, 0.21, 0.02), horizons=[5, 10, 20, 50], infinite=True)
+print(database_values.round(0))
+
+
+# --- UNCERTAINTY OF THE DATABASE VALUE --------------------
+
+
+# Customers of 2015 with their 2014 segment (none for new customers) and
+# the revenue they generated in 2015
+forward = pd.merge(customers_2015[['customer_id', 'segment']], customers_2014[['customer_id', 'segment']], on='customer_id', how='left')
+forward = pd.merge(forward, compute_revenue(data, 2015), how='left')
+forward.revenue_2015 = forward.revenue_2015.fillna(0)
+
+# Bootstrap the customers, re-estimate the transition matrix and the revenue
+# per segment for each replicate, and project today's segments forward
+intervals, worth = simulate_clv(forward.segment_y.cat.codes, forward.segment_x.cat.codes, forward.revenue_2015, customers_2015.segment.value_counts(sort=False), n_replicates=1000, horizon=10, discount_rate=discount_rate)
+
+# 5%, 50% and 95% percentiles of yearly and discounted cumulated revenue
+print(intervals.round(0))
+
+# What is the database worth, with a 90% interval?
+print(worth.round(0))
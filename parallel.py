@@ -0,0 +1,146 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    PARALLEL - SHARDED MULTI-CORE RFM AND REVENUE AGGREGATION
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+# Customers are split into shards of about the same number of purchases by
+# customer id range. The raw purchase columns are copied once, as they are,
+# into shared memory, and every worker process of the pool attaches to them
+# instead of receiving a pickled copy. All the per-row work is done by the
+# workers: each task selects the rows of its own id range (keeping their
+# original order), derives days since the reference date, amounts and years
+# for them, and aggregates them with the same kernel as
+# rfm.compute_customers(), for every offset and year at once. Since shards
+# are id ranges the partial results concatenate directly in customer id
+# order; the parent only samples the shard bounds and copies the columns.
+# Scaling with n_jobs is measured by the rfm_parallel stage of benchmark.py.
+# Results are identical to the single-core functions, e.g.
+#
+#   customers = parallel_customers(data, offsets=[0, 365], years=[2015], n_jobs=32)
+#   customers_2015, customers_2014 = customers['customers']
+#   revenue_2015, = customers['revenue']
+#
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from purchases import REFERENCE_DATE, day_number, year_of, purchase_amounts
+from rfm import check_columns, rfm_aggregates, customers_frame, revenue_frame
+from instrument import traced
+
+
+# --- SHARED COLUMNS ---------------------------------------
+
+
+# Copy arrays into shared memory blocks; the spec (name, dtype, length) of
+# each block is all a worker needs to attach to it
+def share_columns(columns):
+    blocks, spec = [], {}
+    for c, values in columns.items():
+        values = np.asarray(values)
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.copyto(np.ndarray(values.shape, values.dtype, buffer=block.buf), values)
+        blocks.append(block)
+        spec[c] = (block.name, values.dtype.str, len(values))
+    return blocks, spec
+
+
+def release_columns(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+# Columns and reference day of the worker process, attached once by the pool initializer
+WORKER = {}
+
+
+def attach_columns(spec, reference_day):
+    WORKER['blocks'] = [shared_memory.SharedMemory(name=name) for name, _, _ in spec.values()]
+    WORKER['columns'] = {c: np.ndarray(n, np.dtype(dtype), buffer=block.buf)
+                         for (c, (_, dtype, n)), block in zip(spec.items(), WORKER['blocks'])}
+    WORKER['reference_day'] = reference_day
+
+
+# --- SHARDS -----------------------------------------------
+
+
+# Customer id boundaries splitting the purchases into n_shards shards of
+# about the same size, from a sample of the ids (drawn with replacement,
+# which is all quantiles need and does not shuffle the whole column)
+def shard_bounds(customer_id, n_shards, sample=1000000, seed=0):
+    customer_id = np.asarray(customer_id)
+    if len(customer_id) > sample:
+        customer_id = customer_id[np.random.default_rng(seed).integers(0, len(customer_id), sample)]
+    inner = np.unique(np.quantile(customer_id, np.linspace(0, 1, n_shards + 1)[1:-1], method='higher')) if len(customer_id) else []
+    return np.asarray(inner, dtype=np.int64)
+
+
+# Rows of the customers with lo <= id < hi (None: unbounded), in their
+# original order, with days_since and amounts derived as in purchases.py
+def shard_rows(lo, hi):
+    columns = WORKER['columns']
+    customer_id = columns['customer_id']
+    keep = np.ones(len(customer_id), dtype=bool) if lo is None else customer_id >= lo
+    if hi is not None:
+        keep &= customer_id < hi
+    rows = {c: values[keep] for c, values in columns.items()}
+    if 'days_since' not in rows:
+        rows['days_since'] = WORKER['reference_day'] - rows['day'].astype(np.int32)
+    if 'year_of_purchase' not in rows and 'day' in rows:
+        rows['year_of_purchase'] = year_of(rows['day'])
+    rows['purchase_amount'] = purchase_amounts(rows)
+    return rows
+
+
+# Partial RFM aggregates of one shard for each offset (purchases made more
+# than 'offset' days before the reference date) and partial revenue for each year
+def shard_aggregates(lo, hi, offsets, years):
+    rows = shard_rows(lo, hi)
+    rfm = []
+    for o in offsets:
+        keep = rows['days_since'] > o
+        rfm.append(rfm_aggregates(rows['customer_id'][keep], rows['days_since'][keep], rows['purchase_amount'][keep]))
+    revenue = []
+    for y in years:
+        keep = rows['year_of_purchase'] == y
+        ids, _, _, _, total, _ = rfm_aggregates(rows['customer_id'][keep], rows['days_since'][keep], rows['purchase_amount'][keep])
+        revenue.append((ids, total))
+    return rfm, revenue
+
+
+# --- PARALLEL AGGREGATION ---------------------------------
+
+
+# Customers as of each offset (as rfm.compute_customers(data, offset, columns))
+# and revenue of each year (as rfm.compute_revenue(data, year)), from one
+# pool of n_jobs processes and one copy of the columns in shared memory
+# Returns {'customers': [frame per offset], 'revenue': [frame per year]}
+@traced('rfm_parallel')
+def parallel_customers(data, offsets=(0,), years=(), columns=('recency', 'first_purchase', 'frequency', 'amount'),
+                       n_jobs=None, n_shards=None):
+    check_columns(columns)
+    n_jobs = n_jobs or os.cpu_count()
+    # The raw columns as they are: a full frame has days_since and years, a
+    # compact one only days, from which the workers derive them
+    names = ['customer_id', 'purchase_amount', 'days_since', 'day'] + (['year_of_purchase'] if len(years) else [])
+    raw = {c: np.asarray(data[c]) for c in names if c in data}
+    reference_day = getattr(data, 'attrs', {}).get('reference_day', day_number(REFERENCE_DATE))
+    inner = shard_bounds(raw['customer_id'], n_shards or n_jobs)
+    shards = list(zip([None] + list(inner), list(inner) + [None]))
+    blocks, spec = share_columns(raw)
+    del raw
+    try:
+        with ProcessPoolExecutor(n_jobs, initializer=attach_columns, initargs=(spec, reference_day)) as pool:
+            parts = list(pool.map(shard_aggregates, *zip(*[(lo, hi, list(offsets), list(years)) for lo, hi in shards])))
+    finally:
+        release_columns(blocks)
+    result = {'customers': [], 'revenue': []}
+    for k, o in enumerate(offsets):
+        result['customers'].append(customers_frame(*[np.concatenate(p) for p in zip(*[rfm[k] for rfm, _ in parts])], offset=o, columns=columns))
+    for k, y in enumerate(years):
+        result['revenue'].append(revenue_frame(*[np.concatenate(p) for p in zip(*[revenue[k] for _, revenue in parts])], year=y))
+    return result
@@ -0,0 +1,273 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    PIPELINE - HEADLESS MODULES 0 TO 4
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+# The computations of module0.py to module4.py as importable functions, and a
+# command line entry point that runs them without a display, e.g.
+#
+#   python pipeline.py fit --models models.json
+#   python pipeline.py score --models models.json --output out/
+#   python pipeline.py clv --discount-rate 0.10 --horizon 10 --output out/
+#   python pipeline.py all --output out/ --plots charts/
+#
+# Heavy libraries (statsmodels, sklearn, scipy, matplotlib) are only imported
+# by the stages that need them: scoring with saved models never loads
+# statsmodels, and nothing loads matplotlib unless charts are requested.
+#
+import os
+import sys
+import json
+import argparse
+import pandas as pd
+import numpy as np
+from purchases import REFERENCE_DATE, load_purchases, day_number
+from rfm import RFM_MODEL_COLUMNS, compute_customers, compute_revenue, compute_panel, panel_slice
+from segmentation import SEGMENTS, segment_snapshots
+from cube import build_cube, yearly_summary
+from scoring import extract_model, score_customers
+from clv import transition_matrix, project_segments, database_value
+import instrument
+
+
+# The modules compare calendar years: the reference date must be a January
+# 1st, and the year studied is the one ending there (2015 for 2016-01-01);
+# customers are taken as of its first day and as of the reference date
+def calendar_year(reference_date):
+    date = pd.Timestamp(reference_date)
+    if (date.month, date.day) != (1, 1):
+        raise ValueError('the reference date must be a January 1st, got %s' % date.date())
+    return date.year - 1
+
+
+def year_start(year):
+    return '%d-01-01' % year
+
+
+# --- MODULE 0 - INTRODUCTION ------------------------------
+
+
+# Number of purchases, average and total amount per year
+def explore(data):
+    return yearly_summary(build_cube(data))
+
+
+# --- MODULE 1 - STATISTICAL SEGMENTATION ------------------
+
+
+# Hierarchical segmentation of all customers on log-amount and standardized
+# recency and frequency; returns the customers with their ClusterNumber and
+# the profile of each segment
+def statistical_segmentation(data, n_clusters=9, n_centroids=1000):
+    from clustering import ward_linkage, cut_customers
+    customers = compute_customers(data, columns=['recency', 'frequency', 'amount'])
+    x = np.column_stack([customers.recency, customers.frequency, np.log(customers.amount)])
+    x = (x - x.mean(axis=0)) / x.std(axis=0)
+    c, leaves = ward_linkage(x, n_centroids=n_centroids)
+    customers['ClusterNumber'] = cut_customers(c, leaves, n_clusters).ClusterNumber.values
+    profile = customers.groupby('ClusterNumber')[['recency', 'frequency', 'amount']].mean()
+    profile.insert(0, 'size', customers.ClusterNumber.value_counts(sort=False).sort_index())
+    return customers, profile
+
+
+# --- MODULE 2 - MANAGERIAL SEGMENTATION -------------------
+
+
+# Segment customers as of a year ago and today, from one panel
+def managerial_segmentation(data, columns=('recency', 'first_purchase', 'frequency', 'amount'), reference_date=REFERENCE_DATE):
+    dates = [year_start(calendar_year(reference_date)), reference_date]
+    panel = compute_panel(data, dates, columns)
+    customers_2014 = panel_slice(panel, dates[0])
+    customers_2015 = panel_slice(panel, dates[1])
+    customers_2014['segment'], customers_2015['segment'] = segment_snapshots([customers_2014, customers_2015])
+    return customers_2014, customers_2015
+
+
+# Average revenue per customer during 'year' (2015), by segment at the end
+# of the year (actual) and at its start (forward)
+def revenue_per_segment(data, customers_2014, customers_2015, year=2015):
+    revenue = compute_revenue(data, year)
+    column = 'revenue_%d' % year
+    result = {}
+    for name, customers in [('actual', customers_2015), ('forward', customers_2014)]:
+        merged = pd.merge(customers[['customer_id', 'segment']], revenue, how='left')
+        result[name] = merged[column].fillna(0).groupby(merged.segment, observed=False).mean()
+    return pd.DataFrame(result).reindex(SEGMENTS)
+
+
+# --- MODULE 3 - SCORING -----------------------------------
+
+
+# Calibrate the probability (logit) and monetary (log-linear) models on the
+# predictors as of a year before the reference date (2014) and the revenue
+# of the following year (2015); returns them as (terms, coefficients)
+# The reference date must be the one data was loaded with
+def fit_models(data, reference_date=REFERENCE_DATE):
+    year = calendar_year(reference_date)
+    offset = day_number(reference_date) - day_number(year_start(year))
+    in_sample = pd.merge(compute_customers(data, offset=offset, columns=RFM_MODEL_COLUMNS), compute_revenue(data, year), how='left')
+    in_sample['revenue'] = in_sample['revenue_%d' % year].fillna(0)
+    return fit_in_sample(in_sample)
+
+
+# Fit both models on customers with their predictors and the 'revenue' of
+# the following year
+def fit_in_sample(in_sample):
+    import statsmodels.api as sm
+    in_sample = in_sample.assign(active=(in_sample.revenue > 0).astype(int))
+    with instrument.stage('model_fit', len(in_sample)):
+        prob_model = sm.Logit.from_formula('active ~ recency + first_purchase + frequency + avg_amount + max_amount', in_sample).fit(disp=0)
+    active = in_sample[in_sample.active == 1]
+    with instrument.stage('model_fit', len(active)):
+        amount_model = sm.OLS.from_formula('np.log(revenue) ~ np.log(avg_amount) + np.log(max_amount)', active).fit()
+    return extract_model(prob_model), extract_model(amount_model)
+
+
+def save_models(models, path):
+    with open(path, 'w') as f:
+        json.dump({name: {'terms': terms, 'coef': list(coef)} for name, (terms, coef) in zip(['prob', 'amount'], models)}, f, indent=1)
+
+
+def load_models(path):
+    with open(path) as f:
+        models = json.load(f)
+    return tuple((models[name]['terms'], np.asarray(models[name]['coef'])) for name in ['prob', 'amount'])
+
+
+# Score today's customers
+def score(data, models, chunksize=1000000, n_jobs=1):
+    customers_2015 = compute_customers(data, columns=RFM_MODEL_COLUMNS)
+    return score_customers(customers_2015, models[0], models[1], chunksize, n_jobs)
+
+
+# --- MODULE 4 - CUSTOMER LIFETIME VALUE -------------------
+
+
+# Project segments forward and value the database; the revenue per segment
+# is the actual revenue of module 2 (revenue per customer by the segment it
+# was earned in), as in module 4
+def customer_lifetime_value(data, discount_rate=0.10, horizon=10, reference_date=REFERENCE_DATE):
+    year = calendar_year(reference_date)
+    customers_2014, customers_2015 = managerial_segmentation(data, reference_date=reference_date)
+    transition = transition_matrix([customers_2014, customers_2015])
+    counts = customers_2015.segment.value_counts(sort=False).reindex(SEGMENTS).fillna(0)
+    revenue = revenue_per_segment(data, customers_2014, customers_2015, year)['actual'].fillna(0)
+    segments = project_segments(counts, transition, horizon, start=year)
+    yearly_revenue = segments.multiply(revenue.values, axis='index').sum(axis=0)
+    discount = (1 + discount_rate) ** -np.arange(horizon + 1)
+    summary = pd.DataFrame({'yearly_revenue': yearly_revenue,
+                            'cumulated_revenue': yearly_revenue.cumsum(),
+                            'disc_yearly_revenue': yearly_revenue * discount,
+                            'disc_cumulated_revenue': (yearly_revenue * discount).cumsum()})
+    value = database_value(counts, transition, revenue, [discount_rate], [horizon], infinite=True)
+    return transition, segments, summary, value
+
+
+# --- CHARTS -----------------------------------------------
+
+
+# matplotlib is only imported here, with a non-interactive backend
+def save_bar_chart(series, path, title=None):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    series.plot(kind='bar', ax=ax, title=title)
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+# --- COMMAND LINE -----------------------------------------
+
+
+def write_csv(frame, directory, name, index=True):
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        frame.to_csv(os.path.join(directory, name + '.csv'), index=index)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the marketing analytics modules headlessly')
+    parser.add_argument('command', choices=['explore', 'cluster', 'segment', 'fit', 'score', 'clv', 'all'])
+    parser.add_argument('--input', default='purchases.txt', help='purchase log (default: purchases.txt)')
+    parser.add_argument('--reference-date', default=REFERENCE_DATE, help='a January 1st, the end of the year studied (default: 2016-01-01)')
+    parser.add_argument('--output', help='directory for CSV results')
+    parser.add_argument('--plots', help='directory for PNG charts')
+    parser.add_argument('--models', help='JSON file of fitted models: written by fit, read by score if it exists')
+    parser.add_argument('--clusters', type=int, default=9)
+    parser.add_argument('--discount-rate', type=float, default=0.10)
+    parser.add_argument('--horizon', type=int, default=10)
+    parser.add_argument('--jobs', type=int, default=1, help='processes used for scoring')
+    parser.add_argument('--trace', help='write a JSON trace of every stage to this file')
+    args = parser.parse_args(argv)
+    try:
+        year = calendar_year(args.reference_date)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if args.trace:
+        instrument.enable(args.trace)
+
+    data = load_purchases(args.input, args.reference_date, compact=True)
+
+    def run(name):
+        return args.command in (name, 'all')
+
+    if run('explore'):
+        summary = explore(data)
+        print(summary.to_string(index=False))
+        write_csv(summary, args.output, 'yearly_summary', index=False)
+        if args.plots:
+            os.makedirs(args.plots, exist_ok=True)
+            for column in ['counter', 'avg_amount', 'sum_amount']:
+                save_bar_chart(summary.set_index('year_of_purchase')[column], os.path.join(args.plots, 'yearly_%s.png' % column), column)
+
+    if run('cluster'):
+        customers, profile = statistical_segmentation(data, args.clusters)
+        print(profile)
+        write_csv(customers, args.output, 'clusters', index=False)
+        write_csv(profile, args.output, 'cluster_profiles')
+
+    if run('segment'):
+        customers_2014, customers_2015 = managerial_segmentation(data, reference_date=args.reference_date)
+        revenue = revenue_per_segment(data, customers_2014, customers_2015, year)
+        print(revenue)
+        write_csv(customers_2015, args.output, 'segments_%d' % year, index=False)
+        write_csv(revenue, args.output, 'revenue_per_segment')
+        if args.plots:
+            os.makedirs(args.plots, exist_ok=True)
+            save_bar_chart(revenue['forward'].sort_values(ascending=False), os.path.join(args.plots, 'forward_revenue_per_segment.png'), 'forward revenue')
+
+    if run('fit') or (run('score') and not (args.models and os.path.exists(args.models))):
+        models = fit_models(data, args.reference_date)
+        if args.models:
+            save_models(models, args.models)
+        for name, (terms, coef) in zip(['probability', 'monetary'], models):
+            print(name, dict(zip(terms, np.round(coef, 6))))
+
+    if run('score'):
+        if args.models and os.path.exists(args.models):
+            models = load_models(args.models)
+        customers = score(data, models, n_jobs=args.jobs)
+        print(customers[['prob_predicted', 'revenue_predicted', 'score_predicted']].describe())
+        print('customers with an expected revenue above $50:', int((customers.score_predicted > 50).sum()))
+        write_csv(customers, args.output, 'scores', index=False)
+
+    if run('clv'):
+        transition, segments, summary, value = customer_lifetime_value(data, args.discount_rate, args.horizon, args.reference_date)
+        print(summary.round(0))
+        print('database value:', value.round(0).to_dict('records')[0])
+        write_csv(transition, args.output, 'transition')
+        write_csv(segments, args.output, 'segments_projection')
+        write_csv(summary, args.output, 'clv_summary')
+        if args.plots:
+            os.makedirs(args.plots, exist_ok=True)
+            save_bar_chart(summary.disc_cumulated_revenue, os.path.join(args.plots, 'disc_cumulated_revenue.png'), 'discounted cumulated revenue')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
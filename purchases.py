@@ -0,0 +1,239 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    PURCHASES - LOADING AND CACHING THE PURCHASE LOG
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+import os
+import json
+import hashlib
+import pandas as pd
+import numpy as np
+from instrument import stage, traced
+
+
+# Reference date used by all modules to compute days_since
+REFERENCE_DATE = '2016-01-01'
+
+# Typed columns parsed from the text file; 'day' is the purchase date as days since 1970-01-01
+CACHE_COLUMNS = {'customer_id': np.int64, 'purchase_amount': np.float64, 'day': np.int32}
+CACHE_VERSION = 2
+
+# Narrowest types tried for each column by compact_columns(), in order
+COMPACT_TYPES = {'customer_id': [np.int32, np.int64], 'purchase_amount': [np.float32, np.float64], 'day': [np.int16, np.int32]}
+
+
+# --- PARSING THE TEXT FILE --------------------------------
+
+
+RAW_COLUMNS = ['customer_id', 'purchase_amount', 'date_of_purchase']
+
+
+# Convert a raw frame read from the text file into typed columns
+def typed_columns(raw):
+    with stage('to_datetime', len(raw)):
+        day = pd.to_datetime(raw.date_of_purchase).values.astype('datetime64[D]').astype(np.int64)
+    return {'customer_id': raw.customer_id.values.astype(CACHE_COLUMNS['customer_id']),
+            'purchase_amount': raw.purchase_amount.values.astype(CACHE_COLUMNS['purchase_amount']),
+            'day': day.astype(CACHE_COLUMNS['day'])}
+
+
+# Parse the tab-separated text file into typed columns
+def parse_purchases(path):
+    with stage('read_table') as s:
+        raw = pd.read_table(path, header=None, names=RAW_COLUMNS)
+        s.rows = len(raw)
+    return typed_columns(raw)
+
+
+# Parse the text file in blocks of at most 'chunksize' rows, yielding typed columns
+def iter_purchases(path, chunksize=1000000):
+    for raw in pd.read_table(path, header=None, names=RAW_COLUMNS, chunksize=chunksize):
+        yield typed_columns(raw)
+
+
+# Day number (days since 1970-01-01) of a date
+def day_number(date):
+    return int(np.datetime64(pd.Timestamp(date).date(), 'D').astype(np.int64))
+
+
+# Calendar year of day numbers
+def year_of(day):
+    return np.asarray(day).astype('datetime64[D]').astype('datetime64[Y]').astype(np.int64) + 1970
+
+
+# --- COMPACT COLUMNS --------------------------------------
+
+
+# Downcast typed columns to the narrowest type that holds every value:
+# int32 customer ids and int16 day numbers (until 2059) when they fit, and
+# float32 amounts when every amount is a whole number of cents that float32
+# gives back exactly once rounded to the cent (see purchase_amounts())
+# 36 bytes per purchase in the data frame become 10
+def compact_columns(columns):
+    compact = {}
+    for c, types in COMPACT_TYPES.items():
+        values = np.asarray(columns[c])
+        for t in types:
+            if np.issubdtype(t, np.integer):
+                info = np.iinfo(t)
+                fits = len(values) == 0 or (values.min() >= info.min and values.max() <= info.max)
+            else:
+                narrow = values.astype(t)
+                fits = np.array_equal(np.round(narrow.astype(np.float64), 2), values)
+            if fits:
+                compact[c] = values.astype(t, copy=False)
+                break
+        else:
+            compact[c] = values
+    return compact
+
+
+# --- DERIVED COLUMNS --------------------------------------
+
+
+# The functions below read a purchases frame either loaded in full (with
+# date_of_purchase, year_of_purchase and days_since) or compact (customer_id,
+# purchase_amount and day only, everything else derived on demand)
+
+
+# Purchase dates as day numbers (days since 1970-01-01)
+def purchase_days(data):
+    if 'day' in data:
+        return np.asarray(data['day']).astype(np.int64)
+    return np.asarray(data['date_of_purchase']).astype('datetime64[D]').astype(np.int64)
+
+
+# Days between each purchase and the reference date of the frame
+def days_since(data):
+    if 'days_since' in data:
+        return np.asarray(data['days_since'])
+    reference_day = getattr(data, 'attrs', {}).get('reference_day', day_number(REFERENCE_DATE))
+    return reference_day - np.asarray(data['day']).astype(np.int32)
+
+
+def purchase_years(data):
+    if 'year_of_purchase' in data:
+        return np.asarray(data['year_of_purchase'])
+    return year_of(data['day'])
+
+
+# Purchase amounts as float64; compact float32 amounts are whole cents and
+# come back exactly once rounded to the cent
+def purchase_amounts(data):
+    amounts = np.asarray(data['purchase_amount'])
+    if amounts.dtype == np.float32:
+        return np.round(amounts.astype(np.float64), 2)
+    return amounts.astype(np.float64, copy=False)
+
+
+# --- BINARY COLUMNAR CACHE --------------------------------
+
+
+# The cache lives next to the source file, e.g. purchases.txt.cache/
+def cache_dir(path):
+    return path + '.cache'
+
+
+# Identify a version of the source file by its size and modification time,
+# and optionally by a hash of its content
+def source_key(path, verify_hash=False):
+    st = os.stat(path)
+    key = {'version': CACHE_VERSION, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if verify_hash:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        key['sha1'] = h.hexdigest()
+    return key
+
+
+# Memory-map the arrays saved in 'directory' (one .npy file per name), or
+# return None if they are missing or stale for the source file 'path'
+def read_arrays(directory, names, path, verify_hash=False):
+    try:
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    key = source_key(path, verify_hash)
+    if any(meta.get(k) != v for k, v in key.items()):
+        return None
+    try:
+        return {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in names}
+    except (OSError, ValueError):
+        return None
+
+
+# Write the arrays first and the metadata (the source key 'key', taken
+# before the arrays were computed from the source) last, so that an
+# interrupted write never leaves arrays that look valid, and a source changed
+# meanwhile never matches them
+# Each file is written to a temporary name and renamed over the old one:
+# processes that still memory-map the old arrays keep reading them
+def write_arrays(directory, arrays, key):
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    for name, values in arrays.items():
+        array_path = os.path.join(directory, name + '.npy')
+        with open(array_path + '.tmp', 'wb') as f:
+            np.save(f, values)
+        os.replace(array_path + '.tmp', array_path)
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(key, f)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+# Memory-map the cached columns, or return None if the cache is missing or stale
+def read_cache(path, verify_hash=False):
+    return read_arrays(cache_dir(path), CACHE_COLUMNS, path, verify_hash)
+
+
+def write_cache(path, columns, key):
+    write_arrays(cache_dir(path), {c: columns[c] for c in CACHE_COLUMNS}, key)
+
+
+# Return the compact columns of the purchase log, memory-mapped from the
+# cache when it matches the source file, parsed (and cached) otherwise
+def load_columns(path='purchases.txt', cache=True, verify_hash=False):
+    if cache:
+        columns = read_cache(path, verify_hash)
+        if columns is not None:
+            return columns
+    key = source_key(path, verify_hash) if cache else None
+    columns = compact_columns(parse_purchases(path))
+    if cache:
+        try:
+            write_cache(path, columns, key)
+        except OSError:
+            pass
+    return columns
+
+
+# --- BUILDING THE DATA FRAME ------------------------------
+
+
+# Load the purchase log into the 'data' frame used by all modules:
+# customer_id, purchase_amount, date_of_purchase, year_of_purchase, days_since
+# With compact=True the frame only holds the compact customer_id,
+# purchase_amount and day columns, the reference date is kept in data.attrs
+# and the other columns are derived when needed (see DERIVED COLUMNS)
+@traced('load')
+def load_purchases(path='purchases.txt', reference_date=REFERENCE_DATE, cache=True, verify_hash=False, compact=False):
+    columns = load_columns(path, cache, verify_hash)
+    day = np.asarray(columns['day'])
+    reference_day = day_number(reference_date)
+    if compact:
+        data = pd.DataFrame({c: np.asarray(columns[c]) for c in ['customer_id', 'purchase_amount', 'day']})
+        data.attrs['reference_day'] = reference_day
+        return data
+    data = pd.DataFrame({'customer_id': np.asarray(columns['customer_id']).astype(np.int64),
+                         'purchase_amount': purchase_amounts(columns),
+                         'date_of_purchase': day.astype('datetime64[D]').astype('datetime64[ns]')})
+    data['year_of_purchase'] = pd.DatetimeIndex(data['date_of_purchase']).year
+    data['days_since'] = reference_day - day.astype(np.int64)
+    return data
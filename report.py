@@ -0,0 +1,188 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    REPORT - PRE-BINNED CHARTS OF MODULES 0 TO 3
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+# The charts of modules 0 to 3 (yearly bars, histograms of recency,
+# frequency and amounts, segment pie, revenue per segment, scores) as a
+# pack of PNG files. Everything a chart needs (bin counts, summary tables)
+# is computed first in vectorized, chunked passes; the charts only hold
+# these small tables, and are rendered headlessly by a pool of processes, e.g.
+#
+#   python report.py --input purchases.txt --output charts/ --jobs 4
+#   python report.py --input purchases.txt --models models.json --output charts/ --tables tables/
+#
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from purchases import load_purchases
+from rfm import RFM_MODEL_COLUMNS, compute_customers
+from cube import build_cube, yearly_summary
+from segmentation import SEGMENTS
+from scoring import score_customers
+from instrument import traced
+
+
+# --- HISTOGRAMS -------------------------------------------
+
+
+# Counts of values over fixed, equal-width bins, accumulated block by block
+# (e.g. one block of purchases at a time, see purchases.iter_purchases)
+# Bins are closed on the left, the last one on both sides, as numpy.histogram
+# and pandas .hist(); values outside the bins are not counted
+class BinnedHistogram:
+
+    def __init__(self, lo, hi, bins):
+        self.range = (float(lo), float(hi))
+        self.edges = np.linspace(lo, hi, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    # numpy computes the bin of each value arithmetically for equal-width
+    # bins, in blocks, without sorting or a copy of the values
+    def add(self, values):
+        self.counts += np.histogram(values, len(self.counts), self.range)[0]
+        return self
+
+    # Histograms with the same bins add up, e.g. across blocks or processes
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+
+# Histogram of values over 'bins' equal-width bins from their minimum to
+# their maximum (or over value_range), the same bins as values.hist(bins=bins)
+def histogram(values, bins=10, value_range=None):
+    values = np.asarray(values)
+    if value_range is None:
+        value_range = (values.min(), values.max()) if len(values) else (0.0, 1.0)
+    lo, hi = value_range
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5
+    return BinnedHistogram(lo, hi, bins).add(values)
+
+
+# --- CHARTS -----------------------------------------------
+
+
+# A chart is a small dict holding everything needed to draw it:
+# {'name', 'kind': 'bar' | 'hist' | 'pie', 'title', and 'labels' and 'values', or 'edges' and 'counts'}
+
+def bar_chart(name, series, title=None, kind='bar'):
+    return {'name': name, 'kind': kind, 'title': title or name,
+            'labels': [str(x) for x in series.index], 'values': np.asarray(series, dtype=np.float64)}
+
+
+def hist_chart(name, hist, title=None):
+    return {'name': name, 'kind': 'hist', 'title': title or name, 'edges': hist.edges, 'counts': hist.counts}
+
+
+# Summary tables and charts of modules 0 to 3; scores need fitted models
+# (see pipeline.py fit)
+# Returns ({table name: frame}, [charts])
+@traced('report')
+def build_report(data, models=None):
+    from pipeline import managerial_segmentation, revenue_per_segment
+    tables, charts = {}, []
+
+    # Module 0 - purchases per year
+    yearly = yearly_summary(build_cube(data)).set_index('year_of_purchase')
+    tables['yearly_summary'] = yearly
+    for column in ['counter', 'avg_amount', 'sum_amount']:
+        charts.append(bar_chart('yearly_%s' % column, yearly[column]))
+
+    # Modules 1 and 2 - customer distributions, from today's customers with
+    # the columns of the scoring models (amount is avg_amount); zero amounts
+    # have no log and are left out of its histogram
+    customers = compute_customers(data, columns=RFM_MODEL_COLUMNS)
+    amount = customers.avg_amount
+    for name, values, bins in [('recency', customers.recency, 20), ('frequency', customers.frequency, 24),
+                               ('amount', amount, 10), ('amount_99', amount, 99),
+                               ('log_amount', np.log(amount[amount > 0]), 19)]:
+        hist = histogram(values, bins)
+        tables['hist_' + name] = pd.DataFrame({'left': hist.edges[:-1], 'right': hist.edges[1:], 'count': hist.counts})
+        charts.append(hist_chart('hist_' + name, hist))
+
+    # Module 2 - segments
+    customers_2014, customers_2015 = managerial_segmentation(data)
+    counts = customers_2015.segment.value_counts(sort=False).reindex(SEGMENTS).fillna(0)
+    revenue = revenue_per_segment(data, customers_2014, customers_2015)
+    tables['segment_counts'] = counts.to_frame('customers')
+    tables['revenue_per_segment'] = revenue
+    charts.append(bar_chart('segments_2015', counts[counts > 0], kind='pie'))
+    charts.append(bar_chart('forward_revenue_per_segment', revenue['forward'].fillna(0).sort_values(ascending=False)))
+
+    # Module 3 - scores
+    if models is not None:
+        hist = histogram(score_customers(customers, *models).score_predicted, 20)
+        tables['hist_score'] = pd.DataFrame({'left': hist.edges[:-1], 'right': hist.edges[1:], 'count': hist.counts})
+        charts.append(hist_chart('hist_score', hist))
+    return tables, charts
+
+
+# --- RENDERING --------------------------------------------
+
+
+# Draw one chart to directory/<name>.png (matplotlib is only imported here,
+# with a non-interactive backend)
+def render_chart(chart, directory):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    if chart['kind'] == 'hist':
+        ax.stairs(chart['counts'], chart['edges'], fill=True)
+    elif chart['kind'] == 'pie':
+        fig.set_size_inches(6, 6)
+        ax.pie(chart['values'], labels=chart['labels'])
+    else:
+        ax.bar(chart['labels'], chart['values'])
+        ax.tick_params(axis='x', labelrotation=90)
+    ax.set_title(chart['title'])
+    fig.tight_layout()
+    path = os.path.join(directory, chart['name'] + '.png')
+    fig.savefig(path)
+    plt.close(fig)
+    return path
+
+
+# Draw all charts, spread over n_jobs processes
+@traced('render')
+def render_charts(charts, directory, n_jobs=1):
+    os.makedirs(directory, exist_ok=True)
+    if n_jobs > 1 and len(charts) > 1:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            return list(pool.map(render_chart, charts, [directory] * len(charts)))
+    return [render_chart(chart, directory) for chart in charts]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render the chart pack of modules 0 to 3')
+    parser.add_argument('--input', default='purchases.txt')
+    parser.add_argument('--models', help='JSON file of fitted models, adds the score histogram')
+    parser.add_argument('--output', default='charts', help='directory for PNG charts')
+    parser.add_argument('--tables', help='directory for the CSV tables behind the charts')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='processes rendering charts')
+    args = parser.parse_args(argv)
+
+    models = None
+    if args.models:
+        from pipeline import load_models
+        models = load_models(args.models)
+    tables, charts = build_report(load_purchases(args.input, compact=True), models)
+    if args.tables:
+        os.makedirs(args.tables, exist_ok=True)
+        for name, table in tables.items():
+            table.to_csv(os.path.join(args.tables, name + '.csv'))
+    for path in render_charts(charts, args.output, args.jobs):
+        print(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,179 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    RFM - RECENCY, FREQUENCY, MONETARY VALUE
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+import pandas as pd
+import numpy as np
+from purchases import day_number, purchase_days, days_since, purchase_years, purchase_amounts
+from instrument import traced
+
+
+# Columns that compute_customers() knows how to produce
+# 'amount' and 'avg_amount' are both the average purchase amount
+RFM_COLUMNS = ['recency', 'first_purchase', 'frequency', 'amount', 'avg_amount', 'max_amount']
+
+# Predictors of the scoring models of module 3
+RFM_MODEL_COLUMNS = ['recency', 'first_purchase', 'frequency', 'avg_amount', 'max_amount']
+
+
+# Raise ValueError if some of the requested columns are not in 'known'
+def check_columns(columns, known=RFM_COLUMNS, kind='RFM'):
+    unknown = [c for c in columns if c not in known]
+    if unknown:
+        raise ValueError('unknown %s columns: %s' % (kind, ', '.join(unknown)))
+
+
+# --- GROUP BY KERNELS -------------------------------------
+
+
+# Sort purchases by customer once, return the sort order, the distinct
+# customer ids (ascending, like SQL GROUP BY) and the start of each group
+def group_customers(customer_id):
+    customer_id = np.asarray(customer_id)
+    order = np.argsort(customer_id, kind='stable')
+    sorted_id = customer_id[order]
+    starts = np.flatnonzero(np.r_[True, sorted_id[1:] != sorted_id[:-1]]) if len(sorted_id) else np.empty(0, dtype=np.intp)
+    return order, sorted_id[starts], starts
+
+
+# Compute every RFM indicator in a single pass over the purchases
+# Amounts are summed sequentially in row order (np.bincount), like SQLite's SUM/AVG
+def rfm_aggregates(customer_id, days_since, purchase_amount):
+    order, ids, starts = group_customers(customer_id)
+    days = np.asarray(days_since)[order]
+    amounts = np.asarray(purchase_amount, dtype=np.float64)[order]
+    if len(ids) == 0:
+        empty = np.empty(0)
+        return ids, empty.astype(np.int64), empty.astype(np.int64), empty.astype(np.int64), empty, empty
+    group = np.repeat(np.arange(len(ids)), np.diff(np.r_[starts, len(order)]))
+    frequency = np.bincount(group, minlength=len(ids)).astype(np.int64)
+    total = np.bincount(group, weights=amounts, minlength=len(ids))
+    recency = np.minimum.reduceat(days, starts).astype(np.int64)
+    first_purchase = np.maximum.reduceat(days, starts).astype(np.int64)
+    max_amount = np.maximum.reduceat(amounts, starts)
+    return ids, recency, first_purchase, frequency, total, max_amount
+
+
+# --- CUSTOMER LEVEL INDICATORS ----------------------------
+
+
+# Compute recency, frequency, and purchase amounts per customer, as of
+# 'offset' days before the reference date of data.days_since
+# Equivalent to:
+#   SELECT customer_id, MIN(days_since) - offset AS 'recency', MAX(days_since) - offset AS 'first_purchase',
+#          COUNT(*) AS 'frequency', AVG(purchase_amount) AS 'amount', MAX(purchase_amount) AS 'max_amount'
+#   FROM data WHERE days_since > offset GROUP BY 1
+# With n_jobs > 1 the customers are aggregated in shards over a process pool
+# (see parallel.py), with the same result; only worth it with several cores
+@traced('rfm')
+def compute_customers(data, offset=0, columns=('recency', 'first_purchase', 'frequency', 'amount'), n_jobs=1):
+    check_columns(columns)
+    if n_jobs > 1:
+        from parallel import parallel_customers
+        return parallel_customers(data, offsets=[offset], columns=columns, n_jobs=n_jobs)['customers'][0]
+    since = days_since(data)
+    customer_id = np.asarray(data['customer_id'])
+    purchase_amount = purchase_amounts(data)
+    # Purchases made on or after the reference date are not counted either
+    keep = since > offset
+    if not keep.all():
+        since, customer_id, purchase_amount = since[keep], customer_id[keep], purchase_amount[keep]
+    return customers_frame(*rfm_aggregates(customer_id, since, purchase_amount), offset=offset, columns=columns)
+
+
+# Customers frame from the RFM aggregates of rfm_aggregates()
+def customers_frame(ids, recency, first_purchase, frequency, total, max_amount, offset=0, columns=RFM_COLUMNS):
+    average = total / np.maximum(frequency, 1)
+    values = {'recency': recency - offset,
+              'first_purchase': first_purchase - offset,
+              'frequency': frequency,
+              'amount': average,
+              'avg_amount': average,
+              'max_amount': max_amount}
+    customers = pd.DataFrame({'customer_id': ids})
+    for c in columns:
+        customers[c] = values[c]
+    return customers
+
+
+# Compute the revenue generated by each customer during a given year
+# Notice that people with no revenue that year do NOT appear
+# Equivalent to:
+#   SELECT customer_id, SUM(purchase_amount) AS 'revenue_<year>' FROM data WHERE year_of_purchase = <year> GROUP BY 1
+@traced('revenue')
+def compute_revenue(data, year, n_jobs=1):
+    if n_jobs > 1:
+        from parallel import parallel_customers
+        return parallel_customers(data, offsets=[], years=[year], n_jobs=n_jobs)['revenue'][0]
+    keep = purchase_years(data) == year
+    customer_id = np.asarray(data['customer_id'])[keep]
+    purchase_amount = purchase_amounts(data)[keep]
+    order, ids, starts = group_customers(customer_id)
+    group = np.repeat(np.arange(len(ids)), np.diff(np.r_[starts, len(order)]))
+    revenue = np.bincount(group, weights=purchase_amount[order], minlength=len(ids))
+    return revenue_frame(ids, revenue, year)
+
+
+def revenue_frame(ids, revenue, year):
+    return pd.DataFrame({'customer_id': ids, 'revenue_%d' % year: revenue})
+
+
+# --- AS-OF PANELS -----------------------------------------
+
+
+# Compute RFM variables as of several dates at once, from a single sort of the
+# purchases by customer and date
+# As of a given date, only purchases made strictly before that date count, so
+# the purchases of a customer are a prefix of its sorted history, located for
+# all customers and dates with one searchsorted call; running sums and maxima
+# per customer give the amounts at the end of each prefix
+# Returns a frame indexed by (as_of, customer_id), customers with no purchase
+# before a date do not appear for that date; see panel_slice()
+@traced('rfm_panel')
+def compute_panel(data, as_of_dates, columns=('recency', 'first_purchase', 'frequency', 'amount')):
+    check_columns(columns)
+    as_of_dates = pd.DatetimeIndex([pd.Timestamp(d) for d in as_of_dates], name='as_of')
+    as_of = np.array([day_number(d) for d in as_of_dates], dtype=np.int64)
+    day = purchase_days(data)
+    customer_id = np.asarray(data['customer_id'])
+    order = np.lexsort((day, customer_id))
+    customer_id, day = customer_id[order], day[order]
+    amounts = purchase_amounts(data)[order]
+    if len(order):
+        starts = np.flatnonzero(np.r_[True, customer_id[1:] != customer_id[:-1]])
+    else:
+        starts = np.empty(0, dtype=np.intp)
+    ids = customer_id[starts]
+    group = np.repeat(np.arange(len(ids)), np.diff(np.r_[starts, len(order)]))
+    running_total = pd.Series(amounts).groupby(group).cumsum().values
+    running_max = pd.Series(amounts).groupby(group).cummax().values
+
+    # Locate the end of every (customer, date) prefix on a (customer, day) composite key
+    first_day = day.min() if len(day) else 0
+    span = (day.max() - first_day + 2) if len(day) else 1
+    key = group * span + (day - first_day)
+    target = np.arange(len(ids))[:, None] * span + np.clip(as_of - first_day, 0, span - 1)[None, :]
+    ends = np.searchsorted(key, target, side='left')
+    frequency = ends - starts[:, None]
+
+    # Keep the (date, customer) pairs with at least one purchase, date first
+    snapshot, customer = np.nonzero(frequency.T > 0)
+    last = ends[customer, snapshot] - 1
+    frequency = frequency[customer, snapshot]
+    average = running_total[last] / frequency
+    values = {'recency': as_of[snapshot] - day[last],
+              'first_purchase': as_of[snapshot] - day[starts[customer]],
+              'frequency': frequency.astype(np.int64),
+              'amount': average,
+              'avg_amount': average,
+              'max_amount': running_max[last]}
+    index = pd.MultiIndex.from_arrays([as_of_dates[snapshot], ids[customer]], names=['as_of', 'customer_id'])
+    return pd.DataFrame({c: values[c] for c in columns}, index=index)
+
+
+# Customers as of one date, in the same layout as compute_customers()
+def panel_slice(panel, as_of):
+    return panel.xs(pd.Timestamp(as_of), level='as_of').reset_index()
@@ -0,0 +1,103 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    SCORING - BATCH SCORING OF FITTED MODELS
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+import re
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from instrument import traced
+
+
+# A model is reduced to its terms and coefficients, e.g.
+#   (['Intercept', 'recency', 'log(avg_amount)'], array([...]))
+# Supported terms are the intercept, plain columns and log(column)
+TERM = re.compile(r'^(?:(?:np\.)?(log)\((\w+)\)|(\w+))$')
+
+
+# --- EXTRACTING FITTED MODELS -----------------------------
+
+
+# Extract terms and coefficients from a fitted statsmodels formula model
+def extract_model(fit):
+    params = fit.params
+    terms = [str(t) for t in params.index]
+    for t in terms:
+        parse_term(t)
+    return terms, np.asarray(params, dtype=np.float64)
+
+
+# Split a term into its transform and column, (None, None) for the intercept
+def parse_term(term):
+    if term == 'Intercept':
+        return None, None
+    match = TERM.match(term)
+    if match is None:
+        raise ValueError('unsupported model term: %s' % term)
+    if match.group(3) is not None:
+        return None, match.group(3)
+    return match.group(1), match.group(2)
+
+
+# Columns a set of models needs
+def model_columns(*models):
+    columns = []
+    for terms, _ in models:
+        for t in terms:
+            _, column = parse_term(t)
+            if column is not None and column not in columns:
+                columns.append(column)
+    return columns
+
+
+# --- EVALUATING MODELS ------------------------------------
+
+
+# Linear predictor of a model, as a dot product without building a design matrix
+def linear_predictor(model, columns):
+    terms, coef = model
+    n = len(next(iter(columns.values())))
+    eta = np.zeros(n)
+    for t, b in zip(terms, coef):
+        transform, column = parse_term(t)
+        if column is None:
+            eta += b
+        elif transform == 'log':
+            eta += b * np.log(columns[column])
+        else:
+            eta += b * np.asarray(columns[column], dtype=np.float64)
+    return eta
+
+
+# Probability (logit model), expected revenue (log-linear model) and score
+# (scipy is only imported when scoring actually runs)
+def score_chunk(columns, prob_model, amount_model):
+    from scipy.special import expit
+    prob = expit(linear_predictor(prob_model, columns))
+    revenue = np.exp(linear_predictor(amount_model, columns))
+    return prob, revenue, prob * revenue
+
+
+# Score customers chunk by chunk, optionally fanning the chunks out over n_jobs processes
+# Adds prob_predicted, revenue_predicted and score_predicted to the customers frame
+@traced('scoring')
+def score_customers(customers, prob_model, amount_model, chunksize=1000000, n_jobs=1):
+    needed = model_columns(prob_model, amount_model)
+    arrays = {c: np.asarray(customers[c]) for c in needed}
+    n = len(customers)
+    bounds = [(i, min(i + chunksize, n)) for i in range(0, n, chunksize)]
+    chunks = ({c: a[i:j] for c, a in arrays.items()} for i, j in bounds)
+    prob, revenue, score = np.empty(n), np.empty(n), np.empty(n)
+    if n_jobs > 1 and len(bounds) > 1:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            results = list(pool.map(score_chunk, chunks, [prob_model] * len(bounds), [amount_model] * len(bounds)))
+    else:
+        results = (score_chunk(chunk, prob_model, amount_model) for chunk in chunks)
+    for (i, j), (p, r, s) in zip(bounds, results):
+        prob[i:j], revenue[i:j], score[i:j] = p, r, s
+    customers['prob_predicted'] = prob
+    customers['revenue_predicted'] = revenue
+    customers['score_predicted'] = score
+    return customers
@@ -0,0 +1,101 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    SEGMENTATION - MANAGERIAL SEGMENTATION RULES
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+import operator
+import pandas as pd
+import numpy as np
+from instrument import traced
+
+
+# Segments, in an order that makes sense
+SEGMENTS = ['inactive', 'cold', 'warm high value', 'warm low value', 'new warm', 'active high value', 'active low value', 'new active']
+
+# Segment rules: the first rule whose conditions all hold gives the segment
+# Customers matching no rule (recency of exactly one year) get no segment
+SEGMENT_RULES = [
+    ('inactive',          [('recency', '>', 3*365)]),
+    ('cold',              [('recency', '>', 2*365)]),
+    ('new warm',          [('recency', '>', 1*365), ('first_purchase', '<=', 2*365)]),
+    ('warm low value',    [('recency', '>', 1*365), ('amount', '<', 100)]),
+    ('warm high value',   [('recency', '>', 1*365), ('amount', '>=', 100)]),
+    ('new active',        [('recency', '<', 1*365), ('first_purchase', '<=', 365)]),
+    ('active low value',  [('recency', '<', 1*365), ('amount', '<', 100)]),
+    ('active high value', [('recency', '<', 1*365), ('amount', '>=', 100)]),
+]
+
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le, '==': operator.eq, '!=': operator.ne}
+
+
+# --- COMPILING THE RULES ----------------------------------
+
+
+# Compile a rule table into a function mapping columns (a frame, or a dict of
+# arrays of any shape, e.g. customers x snapshots) to int8 segment codes,
+# -1 meaning no segment
+# Rules are applied from last to first so that the first matching rule wins,
+# each one writing its code in place: no intermediate object or string arrays
+# The function also carries the thresholds compared with each column, e.g.
+# evaluate.thresholds['recency'] == [365, 730, 1095]
+def compile_rules(rules=SEGMENT_RULES, segments=SEGMENTS):
+    unknown = [name for name, _ in rules if name not in segments]
+    if unknown:
+        raise ValueError('rules refer to unknown segments: %s' % ', '.join(unknown))
+    compiled = [(np.int8(segments.index(name)), [(column, OPERATORS[op], value) for column, op, value in conditions])
+                for name, conditions in reversed(rules)]
+    variables = sorted({column for _, conditions in rules for column, _, _ in conditions})
+    thresholds = {v: sorted({value for _, conditions in rules for column, _, value in conditions if column == v}) for v in variables}
+
+    def evaluate(columns):
+        values = {v: np.asarray(columns[v]) for v in variables}
+        codes = np.full(values[variables[0]].shape, -1, dtype=np.int8)
+        for code, conditions in compiled:
+            mask = None
+            for column, op, value in conditions:
+                mask = op(values[column], value) if mask is None else mask & op(values[column], value)
+            np.putmask(codes, mask, code)
+        return codes
+
+    evaluate.variables = variables
+    evaluate.thresholds = thresholds
+    return evaluate
+
+
+segment_codes = compile_rules()
+
+
+# --- SEGMENTING CUSTOMERS ---------------------------------
+
+
+# Columns used by the rules; the amount used for the value thresholds is
+# 'amount', or 'avg_amount' if there is no 'amount' column
+def rule_columns(customers, variables):
+    columns = {}
+    for v in variables:
+        if v == 'amount' and 'amount' not in customers:
+            columns[v] = np.asarray(customers['avg_amount'])
+        else:
+            columns[v] = np.asarray(customers[v])
+    return columns
+
+
+# Segment a customers frame, returns an ordered categorical series
+@traced('segmentation')
+def segment_customers(customers, evaluate=segment_codes, segments=SEGMENTS):
+    codes = evaluate(rule_columns(customers, evaluate.variables))
+    return pd.Series(pd.Categorical.from_codes(codes, categories=segments, ordered=True), index=customers.index, name='segment')
+
+
+# Segment several snapshots (e.g. customers_2014 and customers_2015) in one evaluation
+@traced('segmentation')
+def segment_snapshots(snapshots, evaluate=segment_codes, segments=SEGMENTS):
+    if not len(snapshots):
+        return []
+    parts = [rule_columns(s, evaluate.variables) for s in snapshots]
+    columns = {v: np.concatenate([p[v] for p in parts]) for v in evaluate.variables}
+    codes = np.split(evaluate(columns), np.cumsum([len(s) for s in snapshots])[:-1])
+    return [pd.Series(pd.Categorical.from_codes(c, categories=segments, ordered=True), index=s.index, name='segment')
+            for c, s in zip(codes, snapshots)]
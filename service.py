@@ -0,0 +1,238 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    SERVICE - LOCAL LOW-LATENCY SCORING SERVICE
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+# Scores customers on request with the models of module 3. The models and
+# the customer RFM state are loaded once; concurrent requests are coalesced
+# into micro-batches scored with one vectorized evaluation. Runs locally on
+# asyncio, with one JSON request per line over TCP, e.g.
+#
+#   python service.py --models models.json --state state.npz --port 8765
+#   echo '{"customer_id": 10}' | nc 127.0.0.1 8765
+#   echo '{"customer_ids": [10, 20, 30]}' | nc 127.0.0.1 8765
+#   echo '{"stats": true}' | nc 127.0.0.1 8765
+#
+# or, to measure latencies without a network:
+#
+#   python service.py --models models.json --bench 100000 --concurrency 64
+#
+import sys
+import json
+import time
+import asyncio
+import argparse
+import collections
+import numpy as np
+from purchases import load_purchases
+from rfm import RFM_MODEL_COLUMNS
+from scoring import model_columns, score_chunk
+
+
+SCORE_COLUMNS = ['prob_predicted', 'revenue_predicted', 'score_predicted']
+
+
+# --- CUSTOMER STATE ---------------------------------------
+
+
+# Customer ids (ascending) and model columns, from a state saved by
+# incremental.py or computed from the purchase log
+def load_customers(state=None, path='purchases.txt'):
+    if state is not None:
+        from incremental import load_state
+        customer_state = load_state(state)
+        if customer_state.stale.any():
+            customer_state.refresh()
+        return customer_state.ids, customer_state.columns(columns=RFM_MODEL_COLUMNS)
+    from rfm import compute_customers
+    customers = compute_customers(load_purchases(path, compact=True), columns=RFM_MODEL_COLUMNS)
+    return customers.customer_id.values, {c: customers[c].values for c in RFM_MODEL_COLUMNS}
+
+
+# --- MICRO-BATCHING ---------------------------------------
+
+
+class ScoringService:
+
+    # Requests waiting when the batcher wakes up are scored together, up to
+    # max_batch customers; under concurrent load (more than one request
+    # waiting) the batch also waits max_delay seconds for more requests, a
+    # lone request is scored at once
+    def __init__(self, ids, columns, models, max_batch=4096, max_delay=0.001, window=100000):
+        self.ids = np.asarray(ids)
+        self.models = models
+        self.columns = {c: np.asarray(columns[c]) for c in model_columns(*models)}
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.queue = None
+        self.worker = None
+        # Import scipy and warm up now rather than on the first request
+        self.evaluate(self.ids[:1])
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self.run())
+        return self
+
+    async def stop(self):
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+
+    # Customer ids as a 1-D array of the type of self.ids; anything else
+    # (nested lists, fractional, non-numeric or out of range ids) raises
+    # ValueError here rather than failing a whole batch
+    def check_ids(self, customer_ids):
+        ids = np.atleast_1d(np.asarray(customer_ids))
+        with np.errstate(invalid='ignore'):
+            if ids.ndim != 1 or ids.dtype.kind not in 'iuf' or not np.array_equal(ids, ids.astype(self.ids.dtype)):
+                raise ValueError('customer ids must be a list of whole numbers')
+        return ids.astype(self.ids.dtype)
+
+    # Score one customer id or a list of them; returns a dict of arrays,
+    # scores are NaN for unknown customers
+    async def score(self, customer_ids):
+        start = time.perf_counter()
+        customer_ids = self.check_ids(customer_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((customer_ids, future))
+        result = await future
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def drain(self, items, size):
+        while size < self.max_batch and not self.queue.empty():
+            item = self.queue.get_nowait()
+            items.append(item)
+            size += len(item[0])
+        return size
+
+    async def run(self):
+        while True:
+            items = [await self.queue.get()]
+            size = self.drain(items, len(items[0][0]))
+            if size < self.max_batch and self.max_delay > 0 and len(items) > 1:
+                await asyncio.sleep(self.max_delay)
+                size = self.drain(items, size)
+            self.batch_sizes.append(size)
+            try:
+                results = self.evaluate(np.concatenate([ids for ids, _ in items]))
+            except Exception as exc:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            bounds = np.cumsum([0] + [len(ids) for ids, _ in items])
+            for (ids, future), i, j in zip(items, bounds[:-1], bounds[1:]):
+                if not future.done():
+                    future.set_result({'customer_id': ids, **{c: v[i:j] for c, v in results.items()}})
+
+    # Vectorized scoring of a batch of customer ids
+    def evaluate(self, customer_ids):
+        pos = np.searchsorted(self.ids, customer_ids)
+        pos = np.minimum(pos, max(len(self.ids) - 1, 0))
+        found = self.ids[pos] == customer_ids if len(self.ids) else np.zeros(len(customer_ids), dtype=bool)
+        scores = score_chunk({c: a[pos] for c, a in self.columns.items()}, *self.models)
+        return {c: np.where(found, s, np.nan) for c, s in zip(SCORE_COLUMNS, scores)}
+
+    # Latency percentiles in milliseconds over the last requests, and mean batch size
+    def stats(self, percentiles=(50, 90, 99, 99.9)):
+        latencies = np.array(self.latencies) * 1000
+        stats = {'requests': len(latencies), 'mean_batch': float(np.mean(self.batch_sizes)) if self.batch_sizes else None}
+        for p in percentiles:
+            stats['p%g_ms' % p] = float(np.percentile(latencies, p)) if len(latencies) else None
+        return stats
+
+
+# --- SERVING ----------------------------------------------
+
+
+def to_json(result):
+    return {k: [None if isinstance(x, float) and np.isnan(x) else x for x in v.tolist()] for k, v in result.items()}
+
+
+# One JSON request per line: {"customer_id": id}, {"customer_ids": [ids]} or {"stats": true}
+async def handle(service, reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise TypeError('a request is a JSON object, got %s' % type(request).__name__)
+                if request.get('stats'):
+                    response = service.stats()
+                else:
+                    ids = request['customer_ids'] if 'customer_ids' in request else [request['customer_id']]
+                    response = to_json(await service.score(ids))
+            except (ValueError, KeyError, TypeError, OverflowError) as exc:
+                response = {'error': '%s: %s' % (type(exc).__name__, exc)}
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(service, host='127.0.0.1', port=8765):
+    await service.start()
+    server = await asyncio.start_server(lambda r, w: handle(service, r, w), host, port)
+    print('scoring %d customers on %s:%d' % (len(service.ids), host, port), file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+# Send n_requests single-customer requests, 'concurrency' at a time, and
+# return the service statistics
+async def bench(service, n_requests, concurrency=64, seed=0):
+    await service.start()
+    ids = np.random.default_rng(seed).choice(service.ids, n_requests)
+    chunks = np.array_split(ids, concurrency)
+
+    async def client(chunk):
+        for customer_id in chunk:
+            await service.score(customer_id)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(chunk) for chunk in chunks])
+    elapsed = time.perf_counter() - start
+    await service.stop()
+    return dict(service.stats(), requests_per_s=n_requests / elapsed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Score customers on request')
+    parser.add_argument('--models', required=True, help='JSON file of fitted models (see pipeline.py fit)')
+    parser.add_argument('--state', help='customer state saved by incremental.py (default: computed from --input)')
+    parser.add_argument('--input', default='purchases.txt')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch', type=int, default=4096, help='most customers scored together')
+    parser.add_argument('--max-delay', type=float, default=0.001, help='seconds a batch waits for more requests')
+    parser.add_argument('--bench', type=int, help='run this many requests in process and print latencies instead of serving')
+    parser.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args(argv)
+
+    from pipeline import load_models
+    ids, columns = load_customers(args.state, args.input)
+    service = ScoringService(ids, columns, load_models(args.models), args.max_batch, args.max_delay)
+    if args.bench:
+        print(json.dumps(asyncio.run(bench(service, args.bench, args.concurrency)), indent=1))
+        return 0
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
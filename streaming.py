@@ -0,0 +1,130 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    STREAMING - OUT-OF-CORE RFM ACCUMULATION
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+import pandas as pd
+import numpy as np
+from purchases import REFERENCE_DATE, iter_purchases, day_number, year_of
+from rfm import check_columns, group_customers, rfm_aggregates
+from instrument import traced
+
+
+# Per-customer accumulators fed one block of purchases at a time
+# Memory grows with the number of customers, not the number of purchases
+#
+# For each offset (in days before the reference date) we keep, over the
+# purchases made strictly before that date: min and max days_since, count,
+# sum and max of purchase_amount. For each year we keep the revenue (of
+# every year seen with years=None).
+class CustomerAccumulator:
+
+    def __init__(self, offsets=(0, 365), years=(2015,), reference_date=REFERENCE_DATE):
+        self.offsets = tuple(offsets)
+        self.years = tuple(years) if years is not None else None
+        self.reference_day = day_number(reference_date)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.state = {o: self.empty_state(0) for o in self.offsets}
+        self.revenue_state = {y: (np.zeros(0), np.zeros(0, dtype=bool)) for y in self.years or ()}
+
+    @staticmethod
+    def empty_state(n):
+        return {'recency': np.full(n, np.iinfo(np.int64).max, dtype=np.int64),
+                'first_purchase': np.full(n, np.iinfo(np.int64).min, dtype=np.int64),
+                'frequency': np.zeros(n, dtype=np.int64),
+                'total': np.zeros(n),
+                'max_amount': np.full(n, -np.inf)}
+
+    # Make room for customers seen for the first time in this block
+    # Only the block's distinct ids are searched in the sorted ids; the
+    # arrays are reallocated (new ids inserted in place) only if some are new
+    def grow(self, customer_id):
+        block_ids = np.unique(customer_id)
+        pos = np.searchsorted(self.ids, block_ids)
+        known = pos < len(self.ids)
+        known[known] = self.ids[pos[known]] == block_ids[known]
+        if known.all():
+            return
+        at, new_ids = pos[~known], block_ids[~known]
+        empty = self.empty_state(len(new_ids))
+        for o, old in self.state.items():
+            self.state[o] = {k: np.insert(old[k], at, empty[k]) for k in old}
+        for y, (revenue, seen) in self.revenue_state.items():
+            self.revenue_state[y] = (np.insert(revenue, at, 0.0), np.insert(seen, at, False))
+        self.ids = np.insert(self.ids, at, new_ids)
+
+    # Fold a block of purchases (typed columns, see purchases.typed_columns) into the accumulators
+    def add(self, columns):
+        customer_id = np.asarray(columns['customer_id'])
+        purchase_amount = np.asarray(columns['purchase_amount'], dtype=np.float64)
+        day = np.asarray(columns['day'])
+        days_since = self.reference_day - day.astype(np.int64)
+        self.grow(customer_id)
+        for o in self.offsets:
+            keep = days_since > o
+            if not keep.any():
+                continue
+            ids, recency, first_purchase, frequency, total, max_amount = rfm_aggregates(customer_id[keep], days_since[keep], purchase_amount[keep])
+            pos = np.searchsorted(self.ids, ids)
+            state = self.state[o]
+            state['recency'][pos] = np.minimum(state['recency'][pos], recency)
+            state['first_purchase'][pos] = np.maximum(state['first_purchase'][pos], first_purchase)
+            state['frequency'][pos] += frequency
+            state['total'][pos] += total
+            state['max_amount'][pos] = np.maximum(state['max_amount'][pos], max_amount)
+        if self.years is None or self.years:
+            year = year_of(day)
+            for y in self.years if self.years is not None else np.unique(year).tolist():
+                keep = year == y
+                if not keep.any():
+                    continue
+                if y not in self.revenue_state:
+                    self.revenue_state[y] = (np.zeros(len(self.ids)), np.zeros(len(self.ids), dtype=bool))
+                order, ids, starts = group_customers(customer_id[keep])
+                group = np.repeat(np.arange(len(ids)), np.diff(np.r_[starts, len(order)]))
+                total = np.bincount(group, weights=purchase_amount[keep][order], minlength=len(ids))
+                pos = np.searchsorted(self.ids, ids)
+                revenue, seen = self.revenue_state[y]
+                revenue[pos] += total
+                seen[pos] = True
+        return self
+
+    # Same output as rfm.compute_customers(data, offset, columns)
+    def customers(self, offset=0, columns=('recency', 'first_purchase', 'frequency', 'amount')):
+        if offset not in self.state:
+            raise ValueError('offset %d was not accumulated, use offsets=%r' % (offset, self.offsets + (offset,)))
+        check_columns(columns)
+        state = self.state[offset]
+        keep = state['frequency'] > 0
+        frequency = state['frequency'][keep]
+        average = state['total'][keep] / frequency
+        values = {'recency': state['recency'][keep] - offset,
+                  'first_purchase': state['first_purchase'][keep] - offset,
+                  'frequency': frequency,
+                  'amount': average,
+                  'avg_amount': average,
+                  'max_amount': state['max_amount'][keep]}
+        customers = pd.DataFrame({'customer_id': self.ids[keep]})
+        for c in columns:
+            customers[c] = values[c]
+        return customers
+
+    # Same output as rfm.compute_revenue(data, year)
+    def revenue(self, year):
+        if self.years is not None and year not in self.revenue_state:
+            raise ValueError('year %d was not accumulated, use years=%r' % (year, self.years + (year,)))
+        revenue, seen = self.revenue_state.get(year, (np.zeros(len(self.ids)), np.zeros(len(self.ids), dtype=bool)))
+        return pd.DataFrame({'customer_id': self.ids[seen], 'revenue_%d' % year: revenue[seen]})
+
+
+# Read the purchase log in bounded blocks and fold each block into a CustomerAccumulator
+# e.g.  acc = stream_customers('purchases.txt')
+#       customers_2015, customers_2014, revenue_2015 = acc.customers(0), acc.customers(365), acc.revenue(2015)
+@traced('stream_rfm')
+def stream_customers(path='purchases.txt', offsets=(0, 365), years=(2015,), reference_date=REFERENCE_DATE, chunksize=1000000):
+    acc = CustomerAccumulator(offsets, years, reference_date)
+    for columns in iter_purchases(path, chunksize):
+        acc.add(columns)
+    return acc
@@ -0,0 +1,59 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    SYNTHETIC - REPRODUCIBLE SYNTHETIC PURCHASE LOGS
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+import numpy as np
+import pandas as pd
+from purchases import CACHE_COLUMNS, day_number
+
+
+# --- GENERATING PURCHASES ---------------------------------
+
+
+# Generate a purchase log shaped like purchases.txt, as typed columns
+# (customer_id, purchase_amount, day; see purchases.load_columns)
+# - every customer makes 1 + Poisson(purchases_per_customer - 1) purchases
+# - the first purchase is uniform over [start, end], later ones uniform
+#   between the first purchase and end
+# - amounts are log-normal around a customer-specific median drawn around
+#   amount_median, rounded to the cent
+# Purchases come out in random order, as in a real log; the same seed always
+# gives the same log
+def generate_purchases(n_customers, purchases_per_customer=3.0, start='2005-01-01', end='2015-12-31',
+                       amount_median=30.0, amount_sigma=0.8, customer_sigma=0.6, seed=0):
+    rng = np.random.default_rng(seed)
+    first, last = day_number(start), day_number(end)
+    counts = 1 + rng.poisson(max(purchases_per_customer - 1, 0), n_customers)
+    customer = np.repeat(np.arange(n_customers), counts)
+    first_day = rng.integers(first, last + 1, n_customers)
+    is_first = np.r_[True, customer[1:] != customer[:-1]]
+    span = (last - first_day + 1)[customer]
+    day = np.where(is_first, first_day[customer], first_day[customer] + (rng.random(len(customer)) * span).astype(np.int64))
+    median = amount_median * np.exp(customer_sigma * rng.standard_normal(n_customers))
+    amount = np.round(median[customer] * np.exp(amount_sigma * rng.standard_normal(len(customer))), 2)
+    amount = np.maximum(amount, 0.01)
+    order = rng.permutation(len(customer))
+    return {'customer_id': ((customer[order] + 1) * 10).astype(CACHE_COLUMNS['customer_id']),
+            'purchase_amount': amount[order].astype(CACHE_COLUMNS['purchase_amount']),
+            'day': day[order].astype(CACHE_COLUMNS['day'])}
+
+
+# Generate roughly n_rows purchases
+def generate_rows(n_rows, purchases_per_customer=3.0, seed=0, **kwargs):
+    n_customers = max(int(round(n_rows / purchases_per_customer)), 1)
+    return generate_purchases(n_customers, purchases_per_customer, seed=seed, **kwargs)
+
+
+# Write typed columns as a tab-separated text file, like purchases.txt
+def write_purchases(columns, path, chunksize=1000000):
+    n = len(columns['day'])
+    with open(path, 'w') as f:
+        for i in range(0, n, chunksize):
+            j = min(i + chunksize, n)
+            pd.DataFrame({'customer_id': columns['customer_id'][i:j],
+                          'purchase_amount': columns['purchase_amount'][i:j],
+                          'date_of_purchase': np.asarray(columns['day'][i:j]).astype('datetime64[D]').astype(str)}
+                         ).to_csv(f, sep='\t', header=False, index=False)
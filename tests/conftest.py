@@ -0,0 +1,41 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    CONFTEST - SHARED FIXTURES OF THE TESTS
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+# Tests run on a sample of purchases.txt (every customer whose id is a
+# multiple of 10, with all their purchases) or, without the file, on a
+# synthetic log of the same shape, e.g.
+#
+#   python -m pytest -q tests
+#
+import os
+import sys
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from purchases import RAW_COLUMNS, load_purchases
+from synthetic import generate_rows, write_purchases
+
+
+@pytest.fixture(scope='session')
+def purchases_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('data') / 'purchases.txt')
+    source = os.path.join(ROOT, 'purchases.txt')
+    if os.path.exists(source):
+        raw = pd.read_table(source, header=None, names=RAW_COLUMNS)
+        raw[raw.customer_id % 10 == 0].to_csv(path, sep='\t', header=False, index=False)
+    else:
+        write_purchases(generate_rows(20000, seed=1), path)
+    return path
+
+
+@pytest.fixture(scope='session')
+def data(purchases_path):
+    return load_purchases(purchases_path, cache=False)
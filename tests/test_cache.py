@@ -0,0 +1,64 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    TEST CACHE - REBUILDING CACHED ARRAYS UNDER LIVE READERS
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+import numpy as np
+import purchases
+from purchases import load_columns, read_cache
+from history import HISTORY_ARRAYS, load_history, read_history
+from synthetic import generate_rows, write_purchases
+
+
+# Columns memory-mapped before the log changed must stay readable (and
+# unchanged) after the cache is rebuilt for a shorter log
+def test_rebuild_keeps_old_mappings(tmp_path):
+    path = str(tmp_path / 'purchases.txt')
+    write_purchases(generate_rows(20000, seed=1), path)
+    load_columns(path)
+    old = load_columns(path)
+    assert isinstance(old['day'], np.memmap)
+    expected = {c: np.array(v) for c, v in old.items()}
+    write_purchases(generate_rows(200, seed=2), path)
+    assert len(load_columns(path)['day']) < len(expected['day'])
+    for c, values in expected.items():
+        assert np.array_equal(old[c], values)
+
+
+# A log appended while it is parsed must not match the cache of the rows
+# that were parsed
+def test_source_changed_during_parse(tmp_path, monkeypatch):
+    path = str(tmp_path / 'purchases.txt')
+    write_purchases(generate_rows(2000, seed=1), path)
+    parse_purchases = purchases.parse_purchases
+
+    def parse_then_append(p):
+        columns = parse_purchases(p)
+        with open(p, 'a') as f:
+            f.write('10\t25.00\t2015-12-31\n')
+        return columns
+
+    monkeypatch.setattr(purchases, 'parse_purchases', parse_then_append)
+    load_columns(path)
+    assert read_cache(path) is None
+
+
+# A history index kept open (e.g. by a lookup process) must stay readable
+# after the index is rebuilt for a changed log
+def test_rebuild_history_under_open_index(tmp_path):
+    path = str(tmp_path / 'purchases.txt')
+    write_purchases(generate_rows(20000, seed=1), path)
+    load_history(path)
+    old = load_history(path)
+    assert isinstance(old.day, np.memmap)
+    expected = {a: np.array(getattr(old, a)) for a in HISTORY_ARRAYS}
+    features = old.features('2015-01-01')
+    write_purchases(generate_rows(200, seed=2), path)
+    assert len(load_history(path).day) < len(expected['day'])
+    assert read_history(path) is not None
+    for a, values in expected.items():
+        assert np.array_equal(getattr(old, a), values)
+    assert old.features('2015-01-01').equals(features)
@@ -0,0 +1,61 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    TEST CLV - MONTE CARLO AGAINST THE POINT ESTIMATE
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+import numpy as np
+import pandas as pd
+from rfm import compute_revenue, compute_panel, panel_slice
+from segmentation import segment_snapshots
+from pipeline import managerial_segmentation, revenue_per_segment, customer_lifetime_value
+from clv import transition_matrix, project_segments, database_value, simulate_clv
+
+
+# The bootstrap resamples the customers the point estimates come from, so
+# its median must land close to them: today's revenue at t = 0, and the
+# database value of module 4 (revenue per customer by current segment)
+def test_bootstrap_median_matches_database_value(data):
+    customers_2014, customers_2015 = managerial_segmentation(data)
+    transition = transition_matrix([customers_2014, customers_2015])
+    counts = customers_2015.segment.value_counts(sort=False)
+    revenue = revenue_per_segment(data, customers_2014, customers_2015)['actual'].fillna(0)
+    value = database_value(counts, transition, revenue, [0.10], [10]).iloc[0, 0]
+
+    forward = pd.merge(customers_2015[['customer_id', 'segment']], customers_2014[['customer_id', 'segment']], on='customer_id', how='left')
+    forward = pd.merge(forward, compute_revenue(data, 2015), how='left')
+    forward.revenue_2015 = forward.revenue_2015.fillna(0)
+    intervals, worth = simulate_clv(forward.segment_y.cat.codes, forward.segment_x.cat.codes, forward.revenue_2015, counts,
+                                    n_replicates=200, discount_rate=0.10)
+
+    assert np.isclose(intervals['yearly_revenue'][50].iloc[0], forward.revenue_2015.sum(), rtol=0.02)
+    assert np.isclose(worth[50], value, rtol=0.02)
+    assert worth[5] <= value <= worth[95]
+
+
+# pipeline.customer_lifetime_value() must value the database as module 4
+# does, step by step: revenue per customer by current segment (module 2's
+# 'actual' means), so the first year is today's revenue of the customers
+# with a segment
+def test_customer_lifetime_value_matches_module4(data):
+    panel = compute_panel(data, ['2015-01-01', '2016-01-01'])
+    customers_2014 = panel_slice(panel, '2015-01-01')
+    customers_2015 = panel_slice(panel, '2016-01-01')
+    customers_2014['segment'], customers_2015['segment'] = segment_snapshots([customers_2014, customers_2015])
+    transition = transition_matrix([customers_2014, customers_2015], normalize=False)
+    transition = transition.div(transition.sum(axis=1), axis=0).fillna(0)
+    segments = project_segments(customers_2015.segment.value_counts(sort=False), transition, horizon=10, start=2015)
+    actual = pd.merge(customers_2015, compute_revenue(data, 2015), how='left')
+    actual.revenue_2015 = actual.revenue_2015.fillna(0)
+    revenue_per_customer = actual.groupby('segment', observed=False).revenue_2015.mean()
+    yearly_revenue = segments.multiply(revenue_per_customer, axis='index').sum(axis=0)
+    disc_yearly_revenue = yearly_revenue.multiply(1 / ((1 + 0.10) ** np.arange(0, 11)))
+    worth = disc_yearly_revenue.cumsum()[2025] - yearly_revenue[2015]
+
+    _, _, summary, value = customer_lifetime_value(data, discount_rate=0.10, horizon=10)
+    assert np.isclose(summary.yearly_revenue[2015], actual.revenue_2015[actual.segment.notna()].sum(), rtol=1e-9)
+    np.testing.assert_allclose(summary.yearly_revenue.values, yearly_revenue.values, rtol=1e-9)
+    np.testing.assert_allclose(summary.disc_yearly_revenue.values, disc_yearly_revenue.values, rtol=1e-9)
+    assert np.isclose(value.loc[0.10, 10], worth, rtol=1e-9)
@@ -0,0 +1,42 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    TEST INCREMENTAL - PURCHASES AND THE REFERENCE DATE
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+import numpy as np
+import pandas as pd
+import pytest
+from purchases import RAW_COLUMNS, day_number, purchase_days
+from rfm import RFM_MODEL_COLUMNS, compute_customers
+from incremental import build_state, load_state, main
+
+
+# Purchases on or after the reference date are refused, and leave the
+# state as it was
+def test_add_rejects_purchases_on_reference_date(data):
+    state = build_state(data, '2015-12-31')
+    ids = state.ids.copy()
+    today = data[purchase_days(data) == day_number('2015-12-31')]
+    assert len(today)
+    with pytest.raises(ValueError):
+        state.add(today)
+    assert np.array_equal(state.ids, ids)
+    assert not state.stale.any()
+
+
+# update needs a reference date after the new purchases, and then matches
+# the customers of the whole log
+def test_update_command(data, purchases_path, tmp_path):
+    state_path, day_path = str(tmp_path / 'state.npz'), str(tmp_path / 'day.txt')
+    raw = pd.read_table(purchases_path, header=None, names=RAW_COLUMNS)
+    raw[raw.date_of_purchase == '2015-12-31'].to_csv(day_path, sep='\t', header=False, index=False)
+    main(['init', '--input', purchases_path, '--state', state_path, '--reference-date', '2015-12-31'])
+    with pytest.raises(SystemExit):
+        main(['update', '--input', day_path, '--state', state_path])
+    main(['update', '--input', day_path, '--state', state_path, '--reference-date', '2016-01-01'])
+    expected = compute_customers(data, columns=RFM_MODEL_COLUMNS)
+    result = load_state(state_path).customers(RFM_MODEL_COLUMNS)
+    pd.testing.assert_frame_equal(expected, result, check_dtype=False, rtol=1e-9)
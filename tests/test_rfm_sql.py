@@ -0,0 +1,86 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    TEST RFM SQL - VECTORIZED PATHS AGAINST THE SQL OF MODULES 1 TO 3
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+import numpy as np
+import pandas as pd
+import pytest
+from purchases import day_number, purchase_days, load_purchases
+from rfm import RFM_MODEL_COLUMNS, compute_customers, compute_revenue, compute_panel, panel_slice
+from parallel import parallel_customers
+from incremental import build_state
+
+pandasql = pytest.importorskip('pandasql')
+
+
+# --- SQL REFERENCES ---------------------------------------
+
+
+def sql_customers(data, offset=0):
+    query = ("SELECT customer_id, MIN(days_since) - %d AS 'recency', MAX(days_since) - %d AS 'first_purchase', "
+             "COUNT(*) AS 'frequency', AVG(purchase_amount) AS 'avg_amount', MAX(purchase_amount) AS 'max_amount' "
+             "FROM data WHERE days_since > %d GROUP BY 1" % (offset, offset, offset))
+    return pandasql.sqldf(query, {'data': data[['customer_id', 'purchase_amount', 'days_since']]})
+
+
+def sql_revenue(data, year):
+    query = "SELECT customer_id, SUM(purchase_amount) AS 'revenue_%d' FROM data WHERE year_of_purchase = %d GROUP BY 1" % (year, year)
+    return pandasql.sqldf(query, {'data': data[['customer_id', 'purchase_amount', 'year_of_purchase']]})
+
+
+# Amounts are summed in row order like SQLite, except where noted (exact=False)
+def assert_same(expected, result, exact=True):
+    pd.testing.assert_frame_equal(expected, result.reset_index(drop=True)[list(expected.columns)],
+                                  check_exact=exact, check_dtype=False, rtol=1e-9)
+
+
+# --- SINGLE-CORE ------------------------------------------
+
+
+@pytest.mark.parametrize('offset', [0, 365])
+def test_compute_customers(data, offset):
+    assert_same(sql_customers(data, offset), compute_customers(data, offset, RFM_MODEL_COLUMNS))
+
+
+def test_compute_revenue(data):
+    assert_same(sql_revenue(data, 2015), compute_revenue(data, 2015))
+
+
+# Running sums over purchases sorted by date, not in row order
+def test_compute_panel(data):
+    panel = compute_panel(data, ['2015-01-01', '2016-01-01'], RFM_MODEL_COLUMNS)
+    assert_same(sql_customers(data, 365), panel_slice(panel, '2015-01-01'), exact=False)
+    assert_same(sql_customers(data, 0), panel_slice(panel, '2016-01-01'), exact=False)
+
+
+# --- PARALLEL AND INCREMENTAL -----------------------------
+
+
+# Workers derive days since the reference date, amounts and years from the
+# raw columns of a compact frame
+@pytest.mark.parametrize('compact', [False, True])
+def test_parallel_customers(data, purchases_path, compact):
+    frame = load_purchases(purchases_path, cache=False, compact=True) if compact else data
+    result = parallel_customers(frame, offsets=[0, 365], years=[2015], columns=RFM_MODEL_COLUMNS, n_jobs=2)
+    assert_same(sql_customers(data, 0), result['customers'][0])
+    assert_same(sql_customers(data, 365), result['customers'][1])
+    assert_same(sql_revenue(data, 2015), result['revenue'][0])
+
+
+# A state built as of 2015-12-01, fed the purchases of December day by day,
+# must end up where the SQL puts the customers of 2016-01-01
+# Amounts are summed batch by batch, not in row order
+def test_incremental_state(data):
+    day = purchase_days(data)
+    start = day_number('2015-12-01')
+    state = build_state(data, '2015-12-01')
+    for d in range(start, day_number('2016-01-01')):
+        state.advance(np.datetime64(d + 1, 'D'))
+        state.add(data[day == d])
+        state.refresh()
+    assert_same(sql_customers(data, 0), state.customers(RFM_MODEL_COLUMNS), exact=False)
+    assert_same(sql_revenue(data, 2015), state.revenue(2015), exact=False)
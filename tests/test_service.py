@@ -0,0 +1,43 @@
+
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+#    TEST SERVICE - MICRO-BATCHES OF GOOD AND BAD REQUESTS
+# __________________________________________________________
+# //////////////////////////////////////////////////////////
+#
+import asyncio
+import numpy as np
+import pytest
+from rfm import RFM_MODEL_COLUMNS, compute_customers
+from pipeline import fit_models
+from service import ScoringService
+
+
+@pytest.fixture(scope='module')
+def service(data):
+    customers = compute_customers(data, columns=RFM_MODEL_COLUMNS)
+    return ScoringService(customers.customer_id.values, {c: customers[c].values for c in RFM_MODEL_COLUMNS}, fit_models(data))
+
+
+# Requests coalesced into one micro-batch: malformed ones are rejected on
+# their own, the others are scored as if they had come alone
+def test_bad_requests_do_not_fail_the_batch(service):
+    ids = service.ids[:4]
+    requests = [int(ids[0]), [[int(ids[1])]], [int(ids[2]), int(ids[3])], float(ids[0]) + 0.7, ['x'], [float(ids[1])]]
+
+    async def run():
+        await service.start()
+        try:
+            return await asyncio.gather(*[service.score(r) for r in requests], return_exceptions=True)
+        finally:
+            await service.stop()
+
+    results = asyncio.run(run())
+    for i in [1, 3, 4]:
+        assert isinstance(results[i], ValueError)
+    expected = service.evaluate(ids)
+    for i, pos in [(0, [0]), (2, [2, 3]), (5, [1])]:
+        assert np.array_equal(results[i]['customer_id'], ids[pos])
+        assert np.allclose(results[i]['score_predicted'], expected['score_predicted'][pos])
+    assert max(service.batch_sizes) == 4